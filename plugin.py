@@ -15,10 +15,35 @@
         Provides all parsed sensordata as separate devices for control purposes,<br/>
         and a few composite devices for nicer visualisation.<br/>
         <br/>
+        Multiple stations can upload to the same port. The station matching "Station ID"<br/>
+        (or the first station to upload when left empty) uses the original devices,<br/>
+        every other station gets its own set of devices.<br/>
+        All devices share the 255 units of this hardware: about 190 are left for other stations,<br/>
+        roughly 7 stations of 25 devices. Add another WuDirect hardware on another port for more.<br/>
+        <br/>
         Configuration options:
+        <ul style="list-style-type:square">
+            <li>Station ID - ID of the station using the original devices</li>
+            <li>Relay to - space separated list of Wunderground compatible upload URLs the uploads are forwarded to</li>
+            <li>Debug - "Logging" writes all messages to wudirect.log in the plugin folder (rotated at 1 MB)</li>
+            <li>Options - semicolon separated list of:
+                <ul>
+                    <li>stats - create devices with ingest statistics</li>
+                    <li>minimal - answer uploads with an empty 200 OK</li>
+                    <li>ackfirst - answer uploads before processing them in a background thread</li>
+                    <li>spikefilter - discard values far from the median of the recent values</li>
+                    <li>relay=&lt;seconds&gt; - relay only the last upload of every station once per interval</li>
+                    <li>history[=&lt;days&gt;] - record all readings in the plugin folder, served at /history</li>
+                </ul>
+            </li>
+        </ul>
+        Ingest statistics are also available as JSON at http://&lt;domoticz&gt;:&lt;port&gt;/stats<br/>
     </description>
     <params>
         <param field="Port" label="Port" width="30px" required="true" default="8008"/>
+        <param field="Mode1" label="Station ID" width="150px" required="false" default=""/>
+        <param field="Mode2" label="Relay to" width="400px" required="false" default=""/>
+        <param field="Mode3" label="Options" width="300px" required="false" default=""/>
         <param field="Mode6" label="Debug" width="100px">
             <options>
                 <option label="True" value="Debug"/>
@@ -32,6 +57,22 @@
 
 import Domoticz
 import urllib.parse as urlparse
+import bisect
+import calendar
+import collections
+import http.client
+import json
+import math
+import mmap
+import os
+import queue
+import shutil
+import struct
+import sys
+import threading
+import time
+import zlib
+from array import array
 
 SensorTable = {
     'humidity'        :    {
@@ -42,7 +83,11 @@ SensorTable = {
         'offset': 0.0,
         'min'   : 0,
         'max'   : 100,
-        'unit'  : '%'
+        'unit'  : '%',
+        'interval'   : 60,
+        'deadband'   : 1.0,
+        'deadbandpct': 0.0,
+        'refresh'    : 300
     },
     'monthlyrainin'    :    {
         'nr'    : 2,
@@ -52,7 +97,11 @@ SensorTable = {
         'offset': 0.0,
         'min'   : 0,
         'max'   : 100000,
-        'unit'  : ''
+        'unit'  : '',
+        'interval'   : 300,
+        'deadband'   : 0.0,
+        'deadbandpct': 0.0,
+        'refresh'    : 300
     },
     'solarradiation':    {
         'nr'    : 3,
@@ -62,7 +111,11 @@ SensorTable = {
         'offset': 0.0,
         'min'   : 0,
         'max'   : 1380,
-        'unit'  : 'W/m^2'
+        'unit'  : 'W/m^2',
+        'interval'   : 30,
+        'deadband'   : 0.0,
+        'deadbandpct': 5.0,
+        'refresh'    : 300
     },
     'rtfreq'        :    {
         'nr'    : 4,
@@ -72,7 +125,11 @@ SensorTable = {
         'offset': 0.0,
         'min'   : -100,
         'max'   : 100,
-        'unit'  : ''
+        'unit'  : '',
+        'interval'   : 300,
+        'deadband'   : 0.0,
+        'deadbandpct': 0.0,
+        'refresh'    : 300
     },
     'dewptf'        :    {
         'nr'    : 5,
@@ -82,7 +139,11 @@ SensorTable = {
         'offset': -32.0/1.8,
         'min'   : -100,
         'max'   : 100,
-        'unit'  : 'C'
+        'unit'  : 'C',
+        'interval'   : 60,
+        'deadband'   : 0.2,
+        'deadbandpct': 0.0,
+        'refresh'    : 300
     },
     'baromin'    :    {
         'nr'    : 6,
@@ -92,7 +153,11 @@ SensorTable = {
         'offset': 0.0,
         'min'   : 800,
         'max'   : 1040,
-        'unit'  : 'hPa'
+        'unit'  : 'hPa',
+        'interval'   : 60,
+        'deadband'   : 0.3,
+        'deadbandpct': 0.0,
+        'refresh'    : 300
     },
     'tempf'        :    {
         'nr'    : 7,
@@ -102,7 +167,11 @@ SensorTable = {
         'offset': -32.0/1.8,
         'min'   : -100,
         'max'   : 100,
-        'unit'  : 'C'
+        'unit'  : 'C',
+        'interval'   : 60,
+        'deadband'   : 0.2,
+        'deadbandpct': 0.0,
+        'refresh'    : 300
     },
     'windspeedmph':    {
         'nr'    : 8,
@@ -112,7 +181,11 @@ SensorTable = {
         'offset': 0.0,
         'min'   : 0,
         'max'   : 400,
-        'unit'  : 'km/h'
+        'unit'  : 'km/h',
+        'interval'   : 0,
+        'deadband'   : 0.0,
+        'deadbandpct': 0.0,
+        'refresh'    : 300
     },
     'windchillf':    {
         'nr'    : 9,
@@ -122,7 +195,11 @@ SensorTable = {
         'offset': -32.0/1.8,
         'min'   : -100,
         'max'   : 100,
-        'unit'  : 'C'
+        'unit'  : 'C',
+        'interval'   : 60,
+        'deadband'   : 0.2,
+        'deadbandpct': 0.0,
+        'refresh'    : 300
     },
     'indoorhumidity':    {
         'nr'    : 10,
@@ -132,7 +209,11 @@ SensorTable = {
         'offset': 0.0,
         'min'   : 0,
         'max'   : 100,
-        'unit'  : '%'
+        'unit'  : '%',
+        'interval'   : 60,
+        'deadband'   : 1.0,
+        'deadbandpct': 0.0,
+        'refresh'    : 300
     },
     'rainin'        :    {
         'nr'    : 11,
@@ -142,7 +223,11 @@ SensorTable = {
         'offset': 0.0,
         'min'   : 0,
         'max'   : 1000,
-        'unit'  : 'mm/h'
+        'unit'  : 'mm/h',
+        'interval'   : 30,
+        'deadband'   : 0.0,
+        'deadbandpct': 0.0,
+        'refresh'    : 300
     },
     'ID'        :    {
         'nr'    : 12,
@@ -152,7 +237,11 @@ SensorTable = {
         'offset': 0.0,
         'min'   : '',
         'max'   : '',
-        'unit'  : ''
+        'unit'  : '',
+        'interval'   : 0,
+        'deadband'   : 0.0,
+        'deadbandpct': 0.0,
+        'refresh'    : 300
     },
     'dateutc'   :    {
         'nr'    : 13,
@@ -162,7 +251,11 @@ SensorTable = {
         'offset': 0.0,
         'min'   : '',
         'max'   : '',
-        'unit'  : ''
+        'unit'  : '',
+        'interval'   : 0,
+        'deadband'   : 0.0,
+        'deadbandpct': 0.0,
+        'refresh'    : 300
     },
     'UV'        :    {
         'nr'    : 14,
@@ -172,7 +265,11 @@ SensorTable = {
         'offset': 0.0,
         'min'   : 0,
         'max'   : 50,
-        'unit'  : ''
+        'unit'  : '',
+        'interval'   : 60,
+        'deadband'   : 0.0,
+        'deadbandpct': 0.0,
+        'refresh'    : 300
     },
     'indoortempf':    {
         'nr'    : 15,
@@ -182,7 +279,11 @@ SensorTable = {
         'offset': -32.0/1.8,
         'min'   : -100,
         'max'   : 100,
-        'unit'  : 'C'
+        'unit'  : 'C',
+        'interval'   : 60,
+        'deadband'   : 0.2,
+        'deadbandpct': 0.0,
+        'refresh'    : 300
     },
     'winddir'   :    {
         'nr'    : 16,
@@ -192,7 +293,11 @@ SensorTable = {
         'offset': 0.0,
         'min'   : -360,
         'max'   : 360,
-        'unit'  : 'Deg'
+        'unit'  : 'Deg',
+        'interval'   : 0,
+        'deadband'   : 0.0,
+        'deadbandpct': 0.0,
+        'refresh'    : 300
     },
     'absbaromin':    {
         'nr'    : 17,
@@ -202,7 +307,11 @@ SensorTable = {
         'offset': 0.0,
         'min'   : 800,
         'max'   : 1040,
-        'unit'  : ''
+        'unit'  : '',
+        'interval'   : 60,
+        'deadband'   : 0.3,
+        'deadbandpct': 0.0,
+        'refresh'    : 300
     },
     'windgustmph':    {
         'nr'    : 18,
@@ -212,7 +321,11 @@ SensorTable = {
         'offset': 0.0,
         'min'   : 0,
         'max'   : 400,
-        'unit'  : 'km/h'
+        'unit'  : 'km/h',
+        'interval'   : 0,
+        'deadband'   : 0.0,
+        'deadbandpct': 0.0,
+        'refresh'    : 300
     },
     'dailyrainin':    {
         'nr'    : 19,
@@ -222,7 +335,94 @@ SensorTable = {
         'offset': 0.0,
         'min'   : 0,
         'max'   : 10000,
-        'unit'  : 'mm'
+        'unit'  : 'mm',
+        'interval'   : 30,
+        'deadband'   : 0.0,
+        'deadbandpct': 0.0,
+        'refresh'    : 300
+    }
+}
+
+#
+# Numbered channels of add-on sensors (temp1f..temp8f, soilmoisture1.. etc).
+# '%d' in the key and the name is replaced by the channel number 1..'channels',
+# channel n uses unit 'nr' + n - 1. The other fields are as in SensorTable.
+#
+SensorFamilies = {
+    'temp%df'       :    {
+        'nr'    : 110,
+        'channels': 8,
+        'name'  : 'Temperature %d',
+        'type'  : 'Temperature',
+        'scale' : 1.0/1.8,
+        'offset': -32.0/1.8,
+        'min'   : -100,
+        'max'   : 100,
+        'unit'  : 'C',
+        'interval'   : 60,
+        'deadband'   : 0.2,
+        'deadbandpct': 0.0,
+        'refresh'    : 300
+    },
+    'humidity%d'    :    {
+        'nr'    : 120,
+        'channels': 8,
+        'name'  : 'Humidity %d',
+        'type'  : 'Custom',
+        'scale' : 1.0,
+        'offset': 0.0,
+        'min'   : 0,
+        'max'   : 100,
+        'unit'  : '%',
+        'interval'   : 60,
+        'deadband'   : 1.0,
+        'deadbandpct': 0.0,
+        'refresh'    : 300
+    },
+    'soilmoisture%d':    {
+        'nr'    : 130,
+        'channels': 8,
+        'name'  : 'Soil Moisture %d',
+        'type'  : 'Custom',
+        'scale' : 1.0,
+        'offset': 0.0,
+        'min'   : 0,
+        'max'   : 100,
+        'unit'  : '%',
+        'interval'   : 300,
+        'deadband'   : 1.0,
+        'deadbandpct': 0.0,
+        'refresh'    : 900
+    },
+    'leak%d'        :    {
+        'nr'    : 140,
+        'channels': 4,
+        'name'  : 'Leak %d',
+        'type'  : 'Custom',
+        'scale' : 1.0,
+        'offset': 0.0,
+        'min'   : 0,
+        'max'   : 2,
+        'unit'  : 'state',     # 0 dry, 1 leak, 2 offline
+        'interval'   : 0,
+        'deadband'   : 0.0,
+        'deadbandpct': 0.0,
+        'refresh'    : 300
+    },
+    'pm25_ch%d'     :    {
+        'nr'    : 150,
+        'channels': 4,
+        'name'  : 'PM2.5 %d',
+        'type'  : 'Custom',
+        'scale' : 1.0,
+        'offset': 0.0,
+        'min'   : 0,
+        'max'   : 1000,
+        'unit'  : 'ug/m3',
+        'interval'   : 60,
+        'deadband'   : 0.0,
+        'deadbandpct': 5.0,
+        'refresh'    : 300
     }
 }
 
@@ -230,212 +430,2163 @@ CompositeSensors = {
     'THB'       : {
         'nr'    : 100,
         'type'  : "Temp+Hum+Baro",
-        'src'   : ['tempf','humidity','_humstat,humidity,tempf','baromin','_forecast,baromin']
+        'src'   : ['tempf','humidity','_humstat,humidity,tempf','baromin','_forecast,baromin,?barotrend3h'],
+        'interval'   : 60,
+        'deadband'   : 0.2,
+        'deadbandpct': 0.0,
+        'refresh'    : 300
     },
     'WTC'       : {
         'nr'    : 101,
         'type'  : "Wind+Temp+Chill",
-        'src'   :['winddir','_winddir,winddir','_windms10,windspeedmph','_windms10,windgustmph','tempf','windchillf']
+        'src'   :['winddir','_winddir,winddir','_windms10,windspeedmph','_windms10,windgustmph','tempf','_fallback,?windchillf,?windchill'],
+        'interval'   : 0,
+        'deadband'   : 0.0,
+        'deadbandpct': 0.0,
+        'refresh'    : 300
     },
     'Barometer' : {
         'nr'    : 102,
         'type'  : "Barometer",
-        'src'   : ['baromin','_forecast,baromin']
+        'src'   : ['baromin','_forecast,baromin,?barotrend3h'],
+        'interval'   : 60,
+        'deadband'   : 0.3,
+        'deadbandpct': 0.0,
+        'refresh'    : 300
     },
     'Rain'      : {
         'nr'    : 103,
         'type'  : "Rain",
-        'src'   : ['_rain100,rainin','dailyrainin']
+        'src'   : ['_rain100,rainin','dailyrainin'],
+        'interval'   : 30,
+        'deadband'   : 0.0,
+        'deadbandpct': 0.0,
+        'refresh'    : 300
     },
     'UV'        : {
         'nr'    : 104,
         'type'  : "UV",
-        'src':  ['UV','tempf']
+        'src':  ['UV','tempf'],
+        'interval'   : 60,
+        'deadband'   : 0.0,
+        'deadbandpct': 0.0,
+        'refresh'    : 300
+    }
+}
+
+#
+# Rolling window statistics of converted sensors. 'stat' is one of
+# mean, max, min or delta (the change over 'span' seconds).
+#
+WindowSensors = {
+    'windavg10' :    {
+        'nr'    : 20,
+        'name'  : 'Wind Speed 10min',
+        'type'  : 'Custom',
+        'src'   : 'windspeedmph',
+        'stat'  : 'mean',
+        'span'  : 600,
+        'unit'  : 'km/h',
+        'interval'   : 30,
+        'deadband'   : 0.0,
+        'deadbandpct': 2.0,
+        'refresh'    : 300
+    },
+    'windgustmax10': {
+        'nr'    : 21,
+        'name'  : 'Wind Gust Max 10min',
+        'type'  : 'Custom',
+        'src'   : 'windgustmph',
+        'stat'  : 'max',
+        'span'  : 600,
+        'unit'  : 'km/h',
+        'interval'   : 0,
+        'deadband'   : 0.0,
+        'deadbandpct': 0.0,
+        'refresh'    : 300
+    },
+    'barotrend3h':   {
+        'nr'    : 22,
+        'name'  : 'Pressure Tendency 3h',
+        'type'  : 'Custom',
+        'src'   : 'baromin',
+        'stat'  : 'delta',
+        'span'  : 10800,
+        'unit'  : 'hPa',
+        'interval'   : 60,
+        'deadband'   : 0.1,
+        'deadbandpct': 0.0,
+        'refresh'    : 300
+    }
+}
+
+#
+# Sensors calculated from the converted values (Celsius, %, km/h), so they are
+# also available for stations that do not send them. The inputs are rounded to
+# 'quantum' before the calculation and the results are cached per rounded input.
+#
+DerivedSensors = {
+    'windchill' :    {
+        'nr'    : 23,
+        'name'  : 'Wind Chill Calculated',
+        'type'  : 'Temperature',
+        'src'   : ['tempf','windspeedmph'],
+        'quantum': [0.1, 0.1],
+        'function': 'windchill',
+        'unit'  : 'C',
+        'interval'   : 60,
+        'deadband'   : 0.2,
+        'deadbandpct': 0.0,
+        'refresh'    : 300
+    },
+    'heatindex' :    {
+        'nr'    : 24,
+        'name'  : 'Heat Index',
+        'type'  : 'Temperature',
+        'src'   : ['tempf','humidity'],
+        'quantum': [0.1, 1.0],
+        'function': 'heatindex',
+        'unit'  : 'C',
+        'interval'   : 60,
+        'deadband'   : 0.2,
+        'deadbandpct': 0.0,
+        'refresh'    : 300
+    },
+    'apparenttemp':  {
+        'nr'    : 25,
+        'name'  : 'Feels Like',
+        'type'  : 'Temperature',
+        'src'   : ['tempf','humidity','windspeedmph'],
+        'quantum': [0.1, 1.0, 0.1],
+        'function': 'apparent',
+        'unit'  : 'C',
+        'interval'   : 60,
+        'deadband'   : 0.2,
+        'deadbandpct': 0.0,
+        'refresh'    : 300
+    },
+    'dewpoint'  :    {
+        'nr'    : 26,
+        'name'  : 'Dewpoint Calculated',
+        'type'  : 'Temperature',
+        'src'   : ['tempf','humidity'],
+        'quantum': [0.1, 1.0],
+        'function': 'dewpoint',
+        'unit'  : 'C',
+        'interval'   : 60,
+        'deadband'   : 0.2,
+        'deadbandpct': 0.0,
+        'refresh'    : 300
+    }
+}
+
+# Number of cached results per derived sensor, the cache is cleared when full
+DerivedCacheSize = 4096
+
+# Shortest sample interval kept in a window, bounds the memory of a window to span / WindowResolution samples
+WindowResolution = 5
+
+#
+# Spike filter of the "spikefilter" option. A value is rejected when it is further
+# from the median of the last SpikeWindow values than SpikeThreshold times the
+# scaled median absolute deviation (MAD), and at least the tolerance given here
+# in converted units. Rejected values still enter the window, so a lasting change
+# is accepted once it holds the median.
+#
+SpikeFilters = {
+    'tempf'         : 5.0,
+    'indoortempf'   : 5.0,
+    'dewptf'        : 5.0,
+    'windchillf'    : 5.0,
+    'humidity'      : 20.0,
+    'indoorhumidity': 20.0,
+    'baromin'       : 10.0
+}
+
+SpikeWindow     = 15
+SpikeMinSamples = 5
+SpikeThreshold  = 5.0
+
+#
+# Compiled ingest plan
+#
+# SensorTable and CompositeSensors are compiled once in onStart into a fixed
+# plan. Every handled sensor gets a slot index; converted values are kept as
+# native floats in a list indexed by that slot and are only formatted into an
+# sValue when a device is updated.
+#
+class Deadband:
+    __slots__ = ('absolute', 'percentage', 'refresh')
+
+    def __init__(self, device):
+        self.absolute   = device["deadband"]
+        self.percentage = device["deadbandpct"]
+        self.refresh    = device["refresh"]
+
+    # True when any value moved at least the deadband away from the reported one
+    def significant(self, values, reported):
+        absolute = self.absolute
+        percentage = self.percentage / 100.0
+        for value, old in zip(values, reported):
+            if value is None or old is None:
+                if value is not old:
+                    return True
+                continue
+            threshold = max(absolute, percentage * abs(old))
+            if threshold > 0.0:
+                if abs(value - old) >= threshold:
+                    return True
+            elif value != old:
+                return True
+        return False
+
+
+class SensorConverter:
+    __slots__ = ('key', 'index', 'device', 'unit', 'scale', 'offset', 'minval', 'maxval', 'interval', 'deadband')
+
+    def __init__(self, key, index, device):
+        self.key    = key
+        self.index  = index
+        self.device = device
+        self.unit   = device["nr"]
+        self.scale  = device["scale"]
+        self.offset = device["offset"]
+        self.minval = device["min"]
+        self.maxval = device["max"]
+        self.interval = device["interval"]
+        self.deadband = Deadband(device)
+
+    # Returns the converted float, raises ValueError or TypeError when the value is not numeric
+    def convert(self, value):
+        return float(value) * self.scale + self.offset
+
+    def inRange(self, fvalue):
+        return self.minval <= fvalue <= self.maxval
+
+
+#
+# Rolling window over a fixed-size ring of array('d') samples. The running sum
+# gives the mean, and monotonic deques of sample sequence numbers give the
+# maximum and minimum, so adding a sample and reading a statistic are O(1)
+# amortized. Samples older than the span, or beyond the capacity, are dropped.
+#
+class RollingWindow:
+    __slots__ = ('span', 'capacity', 'times', 'values', 'head', 'tail', 'total', 'maxq', 'minq')
+
+    def __init__(self, span, capacity):
+        self.span     = span
+        self.capacity = capacity
+        self.times    = array('d', bytes(8 * capacity))
+        self.values   = array('d', bytes(8 * capacity))
+        self.head     = 0       # sequence number of the oldest sample
+        self.tail     = 0       # sequence number of the next sample
+        self.total    = 0.0
+        self.maxq     = collections.deque()
+        self.minq     = collections.deque()
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def newest(self):
+        return self.times[(self.tail - 1) % self.capacity] if self.tail > self.head else None
+
+    def add(self, when, value):
+        if self.tail > self.head and when < self.times[(self.tail - 1) % self.capacity]:
+            return False
+        if self.tail - self.head == self.capacity:
+            self.drop()
+        capacity = self.capacity
+        values = self.values
+        seq = self.tail
+        self.times[seq % capacity] = when
+        values[seq % capacity] = value
+        self.total += value
+        maxq = self.maxq
+        while maxq and values[maxq[-1] % capacity] <= value:
+            maxq.pop()
+        maxq.append(seq)
+        minq = self.minq
+        while minq and values[minq[-1] % capacity] >= value:
+            minq.pop()
+        minq.append(seq)
+        self.tail = seq + 1
+        self.expire(when)
+        return True
+
+    def drop(self):
+        seq = self.head
+        self.total -= self.values[seq % self.capacity]
+        if self.maxq[0] == seq:
+            self.maxq.popleft()
+        if self.minq[0] == seq:
+            self.minq.popleft()
+        self.head = seq + 1
+        if self.head == self.tail:
+            self.total = 0.0
+
+    def expire(self, now):
+        oldest = now - self.span
+        times = self.times
+        capacity = self.capacity
+        while self.tail > self.head and times[self.head % capacity] < oldest:
+            self.drop()
+
+    def mean(self):
+        count = self.tail - self.head
+        return self.total / count if count else None
+
+    def max(self):
+        return self.values[self.maxq[0] % self.capacity] if self.maxq else None
+
+    def min(self):
+        return self.values[self.minq[0] % self.capacity] if self.minq else None
+
+    # The samples in the window, oldest first, as arrays of times and values
+    def samples(self):
+        times = array('d')
+        values = array('d')
+        for seq in range(self.head, self.tail):
+            times.append(self.times[seq % self.capacity])
+            values.append(self.values[seq % self.capacity])
+        return times, values
+
+    # Change over the span, scaled from the covered period once it covers at least half the span
+    def delta(self):
+        if self.tail - self.head < 2:
+            return None
+        capacity = self.capacity
+        first = self.head % capacity
+        last = (self.tail - 1) % capacity
+        covered = self.times[last] - self.times[first]
+        if covered < self.span / 2.0:
+            return None
+        return (self.values[last] - self.values[first]) * self.span / covered
+
+
+#
+# Median and MAD of the last values, kept in arrival order and in a sorted list.
+# The position of a value in the sorted list is found with bisect. The MAD is
+# the median of the deviations below and above the median, which are two sorted
+# sequences, so it is found with a binary search as well. For an even number of
+# values the lower median is used.
+#
+class SpikeFilter:
+    __slots__ = ('tolerance', 'recent', 'ordered')
+
+    def __init__(self, tolerance):
+        self.tolerance = tolerance
+        self.recent    = collections.deque()   # values in arrival order
+        self.ordered   = []                    # the same values, sorted
+
+    # Add a value, returns False when it is a spike
+    def accept(self, value):
+        ordered = self.ordered
+        count = len(ordered)
+        accepted = True
+        if count >= SpikeMinSamples:
+            middle = (count - 1) // 2
+            median = ordered[middle]
+            limit = SpikeThreshold * 1.4826 * self.deviation(middle, median)
+            accepted = abs(value - median) <= (limit if limit > self.tolerance else self.tolerance)
+        recent = self.recent
+        if count >= SpikeWindow:
+            del ordered[bisect.bisect_left(ordered, recent.popleft())]
+        recent.append(value)
+        bisect.insort(ordered, value)
+        return accepted
+
+    # Median of the absolute deviations from the median at index middle
+    def deviation(self, middle, median):
+        ordered = self.ordered
+        count = len(ordered)
+        below = middle                  # below[i] = median - ordered[middle - 1 - i], ascending
+        above = count - middle          # above[j] = ordered[middle + j] - median, ascending
+        k = middle + 1                  # the lower median is the k-th smallest deviation
+        lo = k - above if k > above else 0
+        hi = k if k < below else below
+        while lo < hi:
+            i = (lo + hi) // 2
+            if median - ordered[middle - 1 - i] < ordered[middle + k - i - 1] - median:
+                lo = i + 1
+            else:
+                hi = i
+        i = lo
+        j = k - i
+        largest = median - ordered[middle - i] if i > 0 else 0.0
+        if j > 0 and ordered[middle + j - 1] - median > largest:
+            largest = ordered[middle + j - 1] - median
+        return largest
+
+
+class WindowNode:
+    __slots__ = ('key', 'index', 'position', 'source', 'device', 'unit', 'statistic', 'span', 'capacity', 'interval', 'deadband')
+
+    def __init__(self, key, index, position, source, device):
+        self.key       = key
+        self.index     = index          # slot of the statistic
+        self.position  = position       # window number within the station
+        self.source    = source         # slot of the sampled sensor
+        self.device    = device
+        self.unit      = device["nr"]
+        self.statistic = getattr(RollingWindow, device["stat"])
+        self.span      = device["span"]
+        self.capacity  = max(2, device["span"] // WindowResolution)
+        self.interval  = device["interval"]
+        self.deadband  = Deadband(device)
+
+    def createWindow(self):
+        return RollingWindow(self.span, self.capacity)
+
+
+class DerivedNode:
+    __slots__ = ('key', 'index', 'sources', 'quanta', 'function', 'cache', 'device', 'unit', 'interval', 'deadband')
+
+    def __init__(self, key, index, sources, function, device):
+        self.key      = key
+        self.index    = index
+        self.sources  = sources         # tuple of source slot indexes
+        self.quanta   = tuple(device["quantum"])
+        self.function = function
+        self.cache    = {}              # rounded inputs -> result
+        self.device   = device
+        self.unit     = device["nr"]
+        self.interval = device["interval"]
+        self.deadband = Deadband(device)
+
+    def evaluate(self, values):
+        steps = []
+        for index, quantum in zip(self.sources, self.quanta):
+            value = values[index]
+            if value is None:
+                return None
+            steps.append(int(round(value / quantum)))
+        steps = tuple(steps)
+        cache = self.cache
+        if steps in cache:
+            return cache[steps]
+        if len(cache) >= DerivedCacheSize:
+            cache.clear()
+        result = self.function(*[step * quantum for step, quantum in zip(steps, self.quanta)])
+        cache[steps] = result
+        return result
+
+
+class CompositeNode:
+    __slots__ = ('name', 'unit', 'parts', 'sources', 'interval', 'deadband')
+
+    def __init__(self, name, unit, parts, device):
+        self.name  = name
+        self.unit  = unit
+        self.parts = parts      # tuple of (function, tuple of source indexes, number of required sources)
+        self.sources = tuple(sorted(set(index for function, indexes, required in parts for index in indexes)))
+        self.interval = device["interval"]
+        self.deadband = Deadband(device)
+
+    # Returns the composite sValue, or None when one of the required sources is missing
+    def evaluate(self, values):
+        data_lst = []
+        for function, indexes, required in self.parts:
+            args = [values[i] for i in indexes]
+            if None in args and None in args[:required]:
+                return None
+            value = function(*args)
+            if value is None:
+                return None
+            data_lst.append(value)
+        return ';'.join(data_lst)
+
+
+# Upload parameters used besides the SensorTable keys
+RecordKeys = ('ID', 'dateutc')
+
+class IngestPlan:
+    __slots__ = ('sensors', 'unhandled', 'keys', 'spikes', 'windows', 'derived', 'slots', 'composites', 'size', 'dependents', 'windowSources', 'derivedSources')
+
+    def __init__(self, sensors, unhandled, windows, derived, composites):
+        self.sensors    = sensors       # key -> SensorConverter
+        self.unhandled  = unhandled     # keys known in SensorTable without a device
+        self.keys       = frozenset(list(sensors) + list(RecordKeys))  # upload parameters worth parsing
+        self.spikes     = tuple((sensors[key].index, tolerance) for key, tolerance in SpikeFilters.items() if key in sensors)
+        self.windows    = windows       # list of WindowNode
+        self.derived    = derived       # list of DerivedNode
+        self.slots      = list(sensors.values()) + windows + derived   # every slot, in index order
+        self.composites = composites    # list of CompositeNode
+        self.size       = len(self.slots)
+        # Windows sampling a slot, and derived sensors calculated from a slot
+        windowSources = [[] for index in range(self.size)]
+        for window in windows:
+            windowSources[window.source].append(window)
+        self.windowSources = [tuple(nodes) for nodes in windowSources]
+        derivedSources = [[] for index in range(self.size)]
+        for node in derived:
+            for index in node.sources:
+                derivedSources[index].append(node)
+        self.derivedSources = [tuple(nodes) for nodes in derivedSources]
+        # Dependency graph: slot index -> positions of the composites using it
+        dependents = [[] for index in range(self.size)]
+        for position, composite in enumerate(composites):
+            for index in composite.sources:
+                dependents[index].append(position)
+        self.dependents = [tuple(positions) for positions in dependents]
+
+    # A SpikeFilter per slot index for the sensors in SpikeFilters, None for the others
+    def createSpikeFilters(self):
+        spikes = [None] * self.size
+        for index, tolerance in self.spikes:
+            spikes[index] = SpikeFilter(tolerance)
+        return spikes
+
+    # Positions of the composites with at least one input among the converted sensors
+    def affected(self, converted):
+        dependents = self.dependents
+        positions = set()
+        for converter in converted:
+            positions.update(dependents[converter.index])
+        return sorted(positions)
+
+
+def compositeValue(value):
+    return "%.1f" % value
+
+def compositeForecast(pressure, tendency=None):
+    return str(getBarometerForecast(pressure, tendency))
+
+def compositeHumStat(humidity, temperature):
+    return str(getHumidityStatus(humidity, temperature))
+
+def compositeWindDir(bearing):
+    return getWindDirection(bearing)
+
+def compositeRain100(rain):
+    return floatToString(rain * 100.0)
+
+def compositeWindMs10(wind):
+    return floatToString(wind * 10.0 / 3.6)
+
+# The first known value, e.g. the wind chill of the station or else the calculated one
+def compositeFallback(value, fallback):
+    if value is None:
+        value = fallback
+    return None if value is None else compositeValue(value)
+
+def derivedWindChill(temperature, windSpeed):
+    return getWindChill(temperature, windSpeed / 3.6)
+
+def derivedApparentTemperature(temperature, humidity, windSpeed):
+    return getApparentTemperature(temperature, humidity, windSpeed / 3.6)
+
+def derivedHeatIndex(temperature, humidity):
+    return getHeatIndex(temperature, humidity)
+
+def derivedDewPoint(temperature, humidity):
+    return getDewPoint(temperature, humidity)
+
+DerivedFunctions = {
+    'windchill' : derivedWindChill,
+    'heatindex' : derivedHeatIndex,
+    'apparent'  : derivedApparentTemperature,
+    'dewpoint'  : derivedDewPoint
+}
+
+CompositeFunctions = {
+    'forecast'  : compositeForecast,
+    'humstat'   : compositeHumStat,
+    'winddir'   : compositeWindDir,
+    'rain100'   : compositeRain100,
+    'windms10'  : compositeWindMs10,
+    'fallback'  : compositeFallback
+}
+
+def CompilePlan():
+    sensors = {}
+    unhandled = set()
+    for key, device in SensorTable.items():
+        if device["name"] != "":
+            sensors[key] = SensorConverter(key, len(sensors), device)
+        else:
+            unhandled.add(key)
+    # Every channel of a family gets its own slot, so a numbered key is found
+    # with the same dict lookup as a SensorTable key
+    for pattern, family in SensorFamilies.items():
+        for channel in range(1, family["channels"] + 1):
+            device = dict(family, nr=family["nr"] + channel - 1, name=family["name"] % channel)
+            key = pattern % channel
+            sensors[key] = SensorConverter(key, len(sensors), device)
+
+    slots = dict((key, converter.index) for key, converter in sensors.items())
+    windows = []
+    for key, device in WindowSensors.items():
+        window = WindowNode(key, len(slots), len(windows), slots[device["src"]], device)
+        slots[key] = window.index
+        windows.append(window)
+
+    derived = []
+    for key, device in DerivedSensors.items():
+        node = DerivedNode(key, len(slots), tuple(slots[src] for src in device["src"]), DerivedFunctions[device["function"]], device)
+        slots[key] = node.index
+        derived.append(node)
+
+    # Function parameters starting with '?' are optional and passed as None when unknown
+    composites = []
+    for name, device in CompositeSensors.items():
+        parts = []
+        for src in device["src"]:
+            if src[0] == '_':
+                function, paramstr = src[1:].split(',', 1)
+                params = paramstr.split(',')
+                required = len([param for param in params if param[0] != '?'])
+                parts.append((CompositeFunctions[function], tuple(slots[param.lstrip('?')] for param in params), required))
+            else:
+                parts.append((compositeValue, (slots[src],), 1))
+        composites.append(CompositeNode(name, device["nr"], tuple(parts), device))
+
+    return IngestPlan(sensors, unhandled, windows, derived, composites)
+
+#
+# Calculate the derived sensors with an input among the changed slots, using the
+# last known values for the other inputs. Returns the derived nodes with a value.
+#
+def DeriveValues(plan, changed, values):
+    derivedSources = plan.derivedSources
+    nodes = set()
+    for slot in changed:
+        nodes.update(derivedSources[slot.index])
+    updated = []
+    for node in sorted(nodes, key=lambda node: node.index):
+        value = node.evaluate(values)
+        values[node.index] = value
+        if value is not None:
+            updated.append(node)
+    return updated
+
+RejectNotNumeric = "NOT numeric"
+RejectOutOfRange = "out of range"
+RejectUnhandled  = "NOT handled"
+RejectUnknown    = "NOT found"
+RejectSpike      = "a spike"
+
+#
+# Convert the parameters of one upload record into the slot values of the plan.
+# This does not depend on Domoticz and is shared with the standalone server.
+# Rejected values are reported as reject(key, value, reason); unhandled and
+# unknown parameters are only reported when verbose is set. spikes holds the
+# SpikeFilter per slot index, or is None without spike filtering.
+# Returns the list of converters that produced a value.
+#
+def ConvertRecord(plan, record, values, reject=None, verbose=False, spikes=None):
+    sensors = plan.sensors
+    converted = []
+    for key, value in record.items():
+        converter = sensors.get(key)
+        if converter is not None:
+            try:
+                fvalue = converter.convert(value)
+            except (TypeError, ValueError):
+                if reject is not None:
+                    reject(key, value, RejectNotNumeric)
+                continue
+            if converter.inRange(fvalue):
+                if spikes is not None:
+                    spike = spikes[converter.index]
+                    if spike is not None and not spike.accept(fvalue):
+                        if reject is not None:
+                            reject(key, fvalue, RejectSpike)
+                        continue
+                values[converter.index] = fvalue
+                converted.append(converter)
+            elif reject is not None:
+                reject(key, fvalue, RejectOutOfRange)
+        elif verbose and reject is not None:
+            reject(key, value, RejectUnhandled if key in plan.unhandled else RejectUnknown)
+    return converted
+
+
+#
+# Ingest statistics
+#
+# Counters and per stage timers of the ingest path. They are served as JSON on
+# the StatsPath of the listener and, with the "stats" option, written to the
+# devices in StatsSensors.
+#
+StatsPath = "/stats"
+
+# Number of heartbeats between updates of the statistics devices
+StatsHeartbeats = 6
+
+StatsSensors = {
+    'messages'  : {
+        'nr'    : 240,
+        'name'  : 'Ingest Messages',
+        'unit'  : 'msg/min'
+    },
+    'rejected'  : {
+        'nr'    : 241,
+        'name'  : 'Ingest Rejected',
+        'unit'  : 'val/min'
+    },
+    'writes'    : {
+        'nr'    : 242,
+        'name'  : 'Ingest DB Writes',
+        'unit'  : 'upd/min'
+    },
+    'cost'      : {
+        'nr'    : 243,
+        'name'  : 'Ingest Time',
+        'unit'  : 'us/msg'
     }
 }
+
+class IngestStats:
+    __slots__ = ('started', 'messages', 'records', 'outOfRange', 'notNumeric', 'spikes', 'duplicates', 'stale', 'writes', 'evicted',
+                 'parseTime', 'convertTime', 'compositeTime', 'updateTime', 'logTime', 'reported')
+
+    def __init__(self):
+        self.started       = time.time()
+        self.messages      = 0
+        self.records       = 0
+        self.outOfRange    = 0
+        self.notNumeric    = 0
+        self.spikes        = 0
+        self.duplicates    = 0
+        self.stale         = 0
+        self.writes        = 0
+        self.evicted       = 0
+        self.parseTime     = 0.0
+        self.convertTime   = 0.0
+        self.compositeTime = 0.0
+        self.updateTime    = 0.0
+        self.logTime       = 0.0
+        self.reported      = None
+
+    def busyTime(self):
+        return self.parseTime + self.convertTime + self.compositeTime + self.updateTime + self.logTime
+
+    def snapshot(self):
+        return {
+            "uptime"    : round(time.time() - self.started, 1),
+            "messages"  : self.messages,
+            "records"   : self.records,
+            "rejected"  : { "outOfRange": self.outOfRange, "notNumeric": self.notNumeric, "spike": self.spikes },
+            "dropped"   : { "duplicate": self.duplicates, "stale": self.stale },
+            "writes"    : self.writes,
+            "evicted"   : self.evicted,
+            "seconds"   : {
+                "parse"     : round(self.parseTime, 6),
+                "convert"   : round(self.convertTime, 6),
+                "composite" : round(self.compositeTime, 6),
+                "update"    : round(self.updateTime, 6),
+                "log"       : round(self.logTime, 6)
+            }
+        }
+
+    # Values for the StatsSensors since the previous call, None on the first call
+    def rates(self, now):
+        current = (now, self.messages, self.outOfRange + self.notNumeric + self.spikes, self.writes, self.busyTime())
+        previous = self.reported
+        self.reported = current
+        if previous is None or current[0] <= previous[0]:
+            return None
+        minutes = (current[0] - previous[0]) / 60.0
+        messages = current[1] - previous[1]
+        return {
+            'messages'  : messages / minutes,
+            'rejected'  : (current[2] - previous[2]) / minutes,
+            'writes'    : (current[3] - previous[3]) / minutes,
+            'cost'      : (current[4] - previous[4]) * 1e6 / messages if messages > 0 else 0.0
+        }
+
+#
+# Logging
+#
+# Messages are formatted only when their level is enabled, so disabled debug
+# messages cost a single comparison. In "File" mode all messages go to a
+# buffered log file in the plugin home folder, which is written on the
+# heartbeat and rotated when it grows beyond LogFileSize bytes.
+#
+LevelDebug = 10
+LevelInfo  = 20
+LevelError = 40
+
+LogFileName  = "wudirect.log"
+LogFileSize  = 1024 * 1024
+LogFileCount = 3
+
+class RotatingLogWriter:
+    def __init__(self, path, maxBytes=LogFileSize, backups=LogFileCount):
+        self.path = path
+        self.maxBytes = maxBytes
+        self.backups = backups
+        self.lines = []
+        try:
+            self.size = os.path.getsize(path)
+        except OSError:
+            self.size = 0
+
+    def write(self, line):
+        self.lines.append(line)
+
+    def rotate(self):
+        for index in range(self.backups - 1, 0, -1):
+            source = "%s.%i" % (self.path, index)
+            if os.path.exists(source):
+                os.replace(source, "%s.%i" % (self.path, index + 1))
+        if os.path.exists(self.path):
+            os.replace(self.path, self.path + ".1")
+        self.size = 0
+
+    def flush(self):
+        if not self.lines:
+            return
+        data = "\n".join(self.lines) + "\n"
+        self.lines = []
+        if self.size + len(data) > self.maxBytes:
+            self.rotate()
+        with open(self.path, "a") as f:
+            f.write(data)
+        self.size += len(data)
+
+
+class PluginLogger:
+    def __init__(self):
+        self.level = LevelInfo
+        self.writer = None
+        self.owner = threading.get_ident()
+        self.deferred = collections.deque()     # (level, message) logged by other threads
+
+    # Messages of other threads than the one calling configure are passed to Domoticz on flush
+    def configure(self, mode, folder):
+        self.flush()
+        self.owner = threading.get_ident()
+        self.writer = None
+        if mode == "Debug":
+            self.level = LevelDebug
+        elif mode == "File":
+            self.level = LevelDebug
+            self.writer = RotatingLogWriter(os.path.join(folder, LogFileName))
+        else:
+            self.level = LevelInfo
+
+    def isDebug(self):
+        return self.level <= LevelDebug
+
+    def debug(self, message, *args):
+        if self.level <= LevelDebug:
+            self.emit(LevelDebug, message, args)
+
+    def info(self, message, *args):
+        if self.level <= LevelInfo:
+            self.emit(LevelInfo, message, args)
+
+    def error(self, message, *args):
+        self.emit(LevelError, message, args)
+
+    def emit(self, level, message, args):
+        if args:
+            message = message % args
+        if threading.get_ident() != self.owner:
+            self.deferred.append((level, message))
+            return
+        if self.writer is not None:
+            self.writer.write("%s %s %s" % (time.strftime("%Y-%m-%d %H:%M:%S"), "ERROR" if level >= LevelError else "INFO " if level >= LevelInfo else "DEBUG", message))
+            if level >= LevelError:
+                Domoticz.Error(message)
+        elif level >= LevelError:
+            Domoticz.Error(message)
+        elif level >= LevelInfo:
+            Domoticz.Log(message)
+        else:
+            Domoticz.Debug(message)
+
+    def flush(self):
+        deferred = self.deferred
+        while deferred:
+            level, message = deferred.popleft()
+            self.emit(level, message, None)
+        if self.writer is not None:
+            try:
+                self.writer.flush()
+            except OSError as e:
+                self.writer = None
+                Domoticz.Error("Log file could not be written, file logging disabled: %s" % (str(e)))
+
+logger = PluginLogger()
+
+#
+# Parse the Options parameter, "stats;name=value" gives {'stats': '', 'name': 'value'}
+#
+def ParseOptions(text):
+    options = {}
+    for item in text.split(';'):
+        name, _, value = item.partition('=')
+        name = name.strip().lower()
+        if name != "":
+            options[name] = value.strip()
+    return options
+
+#
+# Station routing
+#
+# Uploads are routed on their ID parameter through a dict of Station objects.
+# The primary station uses the fixed units from SensorTable and CompositeSensors,
+# every other station gets units allocated from the free unit range. Devices are
+# created on the first value of their key, so a station only gets the devices of
+# the sensors it actually reports.
+# The DeviceID of those devices is "<station>:<key>" (composites use "_<name>"
+# as key), so the allocation is recovered from Devices after a restart.
+#
+MaxUnit = 255
+
+# Seconds without an upload after which the devices of a station are marked timed out
+StationTimeout = 300
+
+# Number of recent dateutc values per station used to recognise retransmitted uploads
+RecentUploads = 32
+
+# Order of an upload against the recent uploads of its station
+RecordFresh     = 0
+RecordDuplicate = 1     # same dateutc as a recent upload, dropped
+RecordStale     = 2     # older than the newest upload, kept away from the devices and the rolling windows
+
+class Station:
+    __slots__ = ('id', 'primary', 'sensorUnits', 'compositeUnits', 'values', 'windows', 'lastSeen', 'timedOut', 'recent', 'newest', 'spikes')
+
+    def __init__(self, id, primary, sensorUnits, compositeUnits, windows):
+        self.id             = id
+        self.primary        = primary
+        self.sensorUnits    = sensorUnits       # unit per plan slot index, None until created, 0 if unavailable
+        self.compositeUnits = compositeUnits    # unit per plan composite, None until created, 0 if unavailable
+        self.values         = [None] * len(sensorUnits)     # last known good value per plan slot
+        self.windows        = windows           # RollingWindow per plan window
+        self.lastSeen       = 0.0
+        self.timedOut       = False
+        self.recent         = collections.OrderedDict()     # last RecentUploads dateutc values
+        self.newest         = None      # newest dateutc, seconds since the epoch
+        self.spikes         = None      # SpikeFilter per plan slot index, with the "spikefilter" option
+
+    # Classify an upload on its dateutc (seconds since the epoch, None for "now")
+    def checkOrder(self, when):
+        if when is None:
+            return RecordFresh
+        recent = self.recent
+        if when in recent:
+            return RecordDuplicate
+        recent[when] = None
+        if len(recent) > RecentUploads:
+            recent.popitem(last=False)
+        if self.newest is not None and when < self.newest:
+            return RecordStale
+        self.newest = when
+        return RecordFresh
+
+    # Sample the converted sensors into the windows sampling them, and return
+    # the window nodes whose statistic has a value
+    def sample(self, plan, converted, values, when, add=True):
+        updated = []
+        windowSources = plan.windowSources
+        for converter in converted:
+            for node in windowSources[converter.index]:
+                window = self.windows[node.position]
+                if add:
+                    window.add(when, values[converter.index])
+                value = node.statistic(window)
+                values[node.index] = value
+                if value is not None:
+                    updated.append(node)
+        return updated
+
+    def units(self):
+        return [unit for unit in self.sensorUnits + self.compositeUnits if unit]
+
+
+class UnitAllocator:
+    def __init__(self, reserved, used):
+        self.free = [unit for unit in range(1, MaxUnit + 1) if unit not in reserved and unit not in used]
+
+    # Allocate count units, as a contiguous range when one is available
+    def allocate(self, count):
+        free = self.free
+        if count > len(free):
+            return None
+        for start in range(0, len(free) - count + 1):
+            if free[start + count - 1] - free[start] == count - 1:
+                units = free[start:start + count]
+                del free[start:start + count]
+                return units
+        units = free[:count]
+        del free[:count]
+        return units
+
+
+def stationDeviceID(stationID, key):
+    return "%s:%s" % (stationID, key)
+
+def createDevice(unit, name, typename, options=None, deviceID=None):
+    extra = {}
+    if options is not None:
+        extra["Options"] = options
+    if deviceID is not None:
+        extra["DeviceID"] = deviceID
+    Domoticz.Device(Name=name, Unit=unit, TypeName=typename, Used=1, **extra).Create()
+
+#
+# Warm start snapshot
+#
+# The last values, the last upload time, the newest dateutc and the rolling window
+# samples of every station are saved in a struct-packed binary file in the plugin folder, on the
+# heartbeat and in onStop, so a restart continues with valid composites and
+# statistics. The file is written to a temporary file and renamed, so it is
+# always complete. A snapshot of a different plan (changed tables) is ignored.
+#
+SnapshotFileName   = "wudirect.snapshot"
+SnapshotMagic      = b"WUDS"
+SnapshotVersion    = 2
+SnapshotHeartbeats = 30
+
+SnapshotHeader  = struct.Struct("<4sHII")       # magic, version, plan signature, station count
+SnapshotStation = struct.Struct("<H?ddHH")      # id length, primary, last upload, newest dateutc, value count, window count
+SnapshotCount   = struct.Struct("<I")
+
+def planSignature(plan):
+    parts = [slot.key for slot in plan.slots]
+    parts += ["%s/%i/%i" % (window.key, window.span, window.capacity) for window in plan.windows]
+    return zlib.crc32(";".join(parts).encode())
+
+def packDoubles(values):
+    data = array('d', values)
+    if sys.byteorder != "little":
+        data.byteswap()
+    return data.tobytes()
+
+def unpackDoubles(buffer, offset, count):
+    data = array('d')
+    data.frombytes(buffer[offset:offset + count * 8])
+    if sys.byteorder != "little":
+        data.byteswap()
+    return data, offset + count * 8
+
+def SaveSnapshot(path, plan, stations):
+    chunks = [SnapshotHeader.pack(SnapshotMagic, SnapshotVersion, planSignature(plan), len(stations))]
+    nan = float("nan")
+    for station in stations:
+        stationID = station.id.encode()
+        newest = nan if station.newest is None else station.newest
+        chunks.append(SnapshotStation.pack(len(stationID), station.primary, station.lastSeen, newest, len(station.values), len(station.windows)))
+        chunks.append(stationID)
+        chunks.append(packDoubles([nan if value is None else value for value in station.values]))
+        for window in station.windows:
+            times, values = window.samples()
+            chunks.append(SnapshotCount.pack(len(times)))
+            chunks.append(packDoubles(times))
+            chunks.append(packDoubles(values))
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as f:
+        f.write(b"".join(chunks))
+    os.replace(temporary, path)
+
+# Returns a list of (station ID, primary, last upload, newest dateutc, values, window samples), None for an unusable snapshot
+def LoadSnapshot(path, plan):
+    try:
+        with open(path, "rb") as f:
+            buffer = memoryview(f.read())
+    except OSError:
+        return None
+    try:
+        magic, version, signature, count = SnapshotHeader.unpack_from(buffer, 0)
+        if magic != SnapshotMagic or version != SnapshotVersion or signature != planSignature(plan):
+            return None
+        offset = SnapshotHeader.size
+        stations = []
+        for number in range(count):
+            idLength, primary, lastSeen, newest, valueCount, windowCount = SnapshotStation.unpack_from(buffer, offset)
+            offset += SnapshotStation.size
+            stationID = bytes(buffer[offset:offset + idLength]).decode()
+            offset += idLength
+            data, offset = unpackDoubles(buffer, offset, valueCount)
+            values = [None if value != value else value for value in data]
+            windows = []
+            for window in range(windowCount):
+                samples, = SnapshotCount.unpack_from(buffer, offset)
+                offset += SnapshotCount.size
+                times, offset = unpackDoubles(buffer, offset, samples)
+                samplevalues, offset = unpackDoubles(buffer, offset, samples)
+                windows.append((times, samplevalues))
+            stations.append((stationID, primary, lastSeen, None if newest != newest else newest, values, windows))
+        return stations
+    except (struct.error, UnicodeDecodeError):
+        return None
+
+#
+# History
+#
+# With the "history" option every accepted reading is appended to a columnar
+# store in the "history" folder of the plugin: one folder per UTC day, in it one
+# folder per station and per sensor key two files of little endian doubles, the
+# times (<key>.t) and the values (<key>.v). Readings are buffered in arrays and
+# appended every HistoryHeartbeats heartbeats. Queries map the files and scan the columns in place
+# through a memoryview, returning min, mean and max per bucket. "history=<days>"
+# removes the days older than that.
+#
+HistoryFolderName  = "history"
+HistoryPath        = "/history"
+HistoryTimes       = ".t"
+HistoryValues      = ".v"
+HistoryDefaultSpan = 86400      # seconds queried when no start is given
+HistoryDefaultStep = 300        # seconds per bucket when no step is given
+HistoryMaxBuckets  = 10000
+HistoryHeartbeats  = 6          # heartbeats between appends to the files
+
+SecondsPerDay = 86400
+
+def historyDay(day):
+    return time.strftime("%Y%m%d", time.gmtime(day * SecondsPerDay))
+
+def historyStation(stationID):
+    return urlparse.quote(stationID, safe="") or "_"
+
+def segmentSize(path):
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+# Make the times and values of a segment the same number of doubles again after an interrupted append
+def AlignSegment(path):
+    sizes = [segmentSize(path + suffix) for suffix in (HistoryTimes, HistoryValues)]
+    size = min(sizes) // 8 * 8
+    for suffix, current in zip((HistoryTimes, HistoryValues), sizes):
+        if current != size:
+            os.truncate(path + suffix, size)
+
+class HistorySegment:
+    __slots__ = ('path', 'times', 'values', 'aligned')
+
+    def __init__(self, path):
+        self.path    = path
+        self.times   = array('d')
+        self.values  = array('d')
+        self.aligned = False
+
+    # Append the buffered readings to the files, returns the number of bytes written.
+    # The buffer is cleared also when writing fails, so it cannot grow without bound;
+    # the files are aligned again before the next append.
+    def flush(self):
+        if not self.times:
+            return 0
+        try:
+            if not self.aligned:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                AlignSegment(self.path)
+                self.aligned = True
+            written = 0
+            for suffix, column in ((HistoryTimes, self.times), (HistoryValues, self.values)):
+                with open(self.path + suffix, "ab") as f:
+                    f.write(packDoubles(column))
+                written += len(column) * 8
+            return written
+        except OSError:
+            self.aligned = False
+            raise
+        finally:
+            del self.times[:]
+            del self.values[:]
+
+# Add the readings of one segment to the buckets, index -> [count, sum, min, max]
+def AccumulateBuckets(times, values, start, end, step, buckets):
+    for when, value in zip(times, values):
+        if start <= when < end:
+            index = int((when - start) // step)
+            bucket = buckets.get(index)
+            if bucket is None:
+                buckets[index] = [1, value, value, value]
+            else:
+                bucket[0] += 1
+                bucket[1] += value
+                if value < bucket[2]:
+                    bucket[2] = value
+                elif value > bucket[3]:
+                    bucket[3] = value
+
+# Scan the columns of a segment in place, only the complete readings are used
+def ScanSegment(path, start, end, step, buckets):
+    try:
+        timesFile = open(path + HistoryTimes, "rb")
+    except OSError:
+        return
+    with timesFile:
+        try:
+            valuesFile = open(path + HistoryValues, "rb")
+        except OSError:
+            return
+        with valuesFile:
+            count = min(os.fstat(timesFile.fileno()).st_size, os.fstat(valuesFile.fileno()).st_size) // 8
+            if count == 0:
+                return
+            with mmap.mmap(timesFile.fileno(), count * 8, access=mmap.ACCESS_READ) as timesMap, \
+                 mmap.mmap(valuesFile.fileno(), count * 8, access=mmap.ACCESS_READ) as valuesMap:
+                with memoryview(timesMap) as timesView, memoryview(valuesMap) as valuesView:
+                    if sys.byteorder != "little":
+                        times, _ = unpackDoubles(timesView, 0, count)
+                        values, _ = unpackDoubles(valuesView, 0, count)
+                        AccumulateBuckets(times, values, start, end, step, buckets)
+                        return
+                    with timesView.cast('d') as times, valuesView.cast('d') as values:
+                        AccumulateBuckets(times, values, start, end, step, buckets)
+
+class HistoryStore:
+    def __init__(self, folder, plan, days=0):
+        self.folder   = folder
+        self.keys     = list(plan.sensors)     # sensor key per slot index
+        self.days     = days            # days to keep, 0 keeps everything
+        self.segments = {}              # (station ID, day) -> HistorySegment or None per sensor slot
+        self.today    = None
+        self.samples  = 0
+        self.bytes    = 0
+        self.errors   = 0
+
+    def segmentPath(self, stationID, key, day):
+        return os.path.join(self.folder, historyDay(day), historyStation(stationID), key)
+
+    # Buffer the converted sensor values of one record, at its time in seconds since the epoch
+    def append(self, stationID, converted, values, when):
+        day = int(when // SecondsPerDay)
+        segments = self.segments.get((stationID, day))
+        if segments is None:
+            segments = self.segments[(stationID, day)] = [None] * len(self.keys)
+        for converter in converted:
+            index = converter.index
+            segment = segments[index]
+            if segment is None:
+                segment = segments[index] = HistorySegment(self.segmentPath(stationID, converter.key, day))
+            segment.times.append(when)
+            segment.values.append(values[index])
+        self.samples += len(converted)
+
+    # Append the buffered readings to the files and forget the segments of other
+    # days than today; on a new day the days beyond the retention are removed
+    def flush(self, now):
+        today = int(now // SecondsPerDay)
+        failed = None
+        for (stationID, day), segments in list(self.segments.items()):
+            for segment in segments:
+                if segment is None:
+                    continue
+                try:
+                    self.bytes += segment.flush()
+                except OSError as e:
+                    self.errors += 1
+                    failed = e
+            if day != today:
+                del self.segments[(stationID, day)]
+        if today != self.today:
+            self.today = today
+            self.expire(today)
+        if failed is not None:
+            raise failed
+
+    def expire(self, today):
+        if not self.days:
+            return
+        oldest = historyDay(today - self.days + 1)
+        try:
+            names = os.listdir(self.folder)
+        except OSError:
+            return
+        for name in names:
+            if len(name) == 8 and name.isdigit() and name < oldest:
+                shutil.rmtree(os.path.join(self.folder, name), ignore_errors=True)
+
+    # Downsample the readings of a sensor between start and end (seconds since the
+    # epoch) into buckets of step seconds. Returns (bucket start, count, min, mean, max)
+    # for every bucket with readings. Flush first to include the buffered readings.
+    def query(self, stationID, key, start, end, step):
+        buckets = {}
+        for day in range(int(start // SecondsPerDay), int((end - 1) // SecondsPerDay) + 1):
+            ScanSegment(self.segmentPath(stationID, key, day), start, end, step, buckets)
+        return [(start + index * step, count, low, total / count, high)
+                for index, (count, total, low, high) in sorted(buckets.items())]
+
+    def snapshot(self):
+        return {
+            "samples"   : self.samples,
+            "bytes"     : self.bytes,
+            "open"      : len(self.segments),
+            "errors"    : self.errors
+        }
+
+#
+# Write coalescing
+#
+# Device updates are buffered per unit, only the latest sValue is kept.
+# onHeartbeat writes a pending value once the minimum interval of the unit
+# (the 'interval' of its SensorTable or CompositeSensors entry) has passed since
+# its previous write. A composite is always buffered as one complete sValue,
+# so it is written atomically.
+#
+# Before a value is buffered it has to pass the deadband of the unit: it must
+# differ at least 'deadband' (absolute) or 'deadbandpct' (percentage) from the
+# last accepted value. After 'refresh' seconds without an accepted value the
+# next one is accepted and written even when unchanged, so the device keeps
+# being updated.
+#
+class DeviceScheduler:
+    def __init__(self):
+        self.pending   = {}     # unit -> (sValue, always update)
+        self.lastWrite = {}     # unit -> time of last write
+        self.intervals = {}     # unit -> minimum seconds between writes
+        self.deadbands = {}     # unit -> Deadband
+        self.accepted  = {}     # unit -> (values, time) last accepted
+
+    def setInterval(self, unit, interval, deadband=None):
+        self.intervals[unit] = interval
+        if deadband is not None:
+            self.deadbands[unit] = deadband
+
+    # Buffer an sValue for a unit, values are the floats it was derived from
+    def schedule(self, unit, sValue, values=None, now=None):
+        refresh = False
+        deadband = self.deadbands.get(unit)
+        if deadband is not None and values is not None:
+            if now is None:
+                now = time.time()
+            accepted = self.accepted.get(unit)
+            if accepted is not None:
+                if now - accepted[1] < deadband.refresh:
+                    if not deadband.significant(values, accepted[0]):
+                        return False
+                else:
+                    refresh = True
+            self.accepted[unit] = (values, now)
+        self.pending[unit] = (sValue, refresh)
+        return True
+
+    # Returns the number of database writes
+    def flush(self, now, force=False):
+        if not self.pending:
+            return 0
+        intervals = self.intervals
+        lastWrite = self.lastWrite
+        flushed = []
+        writes = 0
+        for unit, (sValue, refresh) in self.pending.items():
+            if force or now - lastWrite.get(unit, 0.0) >= intervals.get(unit, 0):
+                if UpdateDevice(unit, 0, sValue, refresh):
+                    writes += 1
+                lastWrite[unit] = now
+                flushed.append(unit)
+        for unit in flushed:
+            del self.pending[unit]
+        return writes
+
+#
+# HTTP responses and connections
+#
+# The response to an upload is built once in onStart. With the "minimal" option
+# it is a 200 OK without body, which is all the stations check. Connections are
+# kept in order of their last message: the least recently used one is closed when
+# more than ConnectionLimit are open, and connections without a message for
+# ConnectionIdleTimeout seconds are closed on the heartbeat.
+#
+ResponseBody = "<!doctype html><html><head></head><body><h1>Successful GET!!!</h1></body></html>"
+
+ConnectionLimit       = 64
+ConnectionIdleTimeout = 300
+
+def BuildResponse(minimal):
+    if minimal:
+        return {"Status":"200 OK", "Headers": {"Connection": "keep-alive"}, "Data": ""}
+    return {"Status":"200 OK", "Headers": {"Connection": "keep-alive", "Accept": "Content-Type: text/html; charset=UTF-8"}, "Data": ResponseBody}
+
+#
+# Acknowledge first
+#
+# With the "ackfirst" option onMessage answers the station right after parsing
+# the request and puts the upload on a bounded queue, the oldest upload is
+# dropped when it is full. A worker thread converts the uploads and schedules
+# the device updates. Devices are only written, created and marked timed out on
+# the heartbeat in the Domoticz thread; the lock of the plugin keeps the worker
+# out while the heartbeat runs. New stations are registered from the units
+# recovered in onStart, so the worker never reads Devices. The counters updated
+# by onMessage have a lock of their own, taken after the acknowledgement.
+#
+IngestQueueSize = 1024
+
+class IngestQueue:
+    def __init__(self, size):
+        self.size     = size
+        self.items    = collections.deque()
+        self.ready    = threading.Condition()
+        self.stopping = False
+        self.queued   = 0
+        self.dropped  = 0
+        self.peak     = 0
+
+    def put(self, item):
+        with self.ready:
+            items = self.items
+            if len(items) >= self.size:
+                items.popleft()
+                self.dropped += 1
+            items.append(item)
+            self.queued += 1
+            if len(items) > self.peak:
+                self.peak = len(items)
+            self.ready.notify()
+
+    # The next item, None once stopped and empty
+    def get(self):
+        with self.ready:
+            while not self.items and not self.stopping:
+                self.ready.wait()
+            return self.items.popleft() if self.items else None
+
+    def stop(self):
+        with self.ready:
+            self.stopping = True
+            self.ready.notify_all()
+
+    def snapshot(self):
+        return {
+            "depth"     : len(self.items),
+            "peak"      : self.peak,
+            "queued"    : self.queued,
+            "dropped"   : self.dropped
+        }
+
+#
+# Relay
+#
+# Uploads can be forwarded to Wunderground compatible endpoints, listed in the
+# "Relay to" field. onMessage only puts the query string on a bounded queue; a
+# background thread sends it to every endpoint over a kept-alive connection and
+# retries failed sends with an exponential backoff. An upload that does not fit
+# in the queue is dropped. With the option relay=<seconds> only the last upload
+# of every station is queued, once per interval, on the heartbeat.
+# The thread does not use the Domoticz API, its counters are logged on the heartbeat.
+#
+RelayQueueSize = 256
+RelayRetries   = 3
+RelayBackoff   = 2.0        # seconds before the first retry, doubled for every next retry
+RelayTimeout   = 10
+
+class RelayEndpoint:
+    def __init__(self, url):
+        parsed = urlparse.urlsplit(url)
+        if parsed.scheme not in ("http", "https") or not parsed.hostname:
+            raise ValueError("Relay endpoint is not an http(s) URL: %s" % url)
+        self.url        = url
+        self.https      = parsed.scheme == "https"
+        self.host       = parsed.hostname
+        self.port       = parsed.port
+        self.path       = parsed.path or "/"
+        self.connection = None
+
+    # Send one query string, returns the HTTP status
+    def send(self, query):
+        if self.connection is None:
+            connectionClass = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            self.connection = connectionClass(self.host, self.port, timeout=RelayTimeout)
+        try:
+            self.connection.request("GET", self.path + "?" + query, headers={"Connection": "keep-alive"})
+            response = self.connection.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            self.close()
+            raise
+        if response.will_close:
+            self.close()
+        return response.status
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class Relay:
+    def __init__(self, endpoints, interval=0):
+        self.endpoints = endpoints
+        self.interval  = interval
+        self.queue     = queue.Queue(RelayQueueSize)
+        self.held      = {}         # station ID -> last query string, when relaying once per interval
+        self.sent      = {}         # station ID -> time the last upload was queued
+        self.stopping  = threading.Event()
+        self.thread    = None
+        self.relayed   = 0
+        self.retried   = 0
+        self.failed    = 0
+        self.dropped   = 0
+        self.lastError = None
+        self.reported  = 0          # failed + dropped at the last report
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="WuDirectRelay")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+        if self.thread is not None:
+            self.thread.join(RelayTimeout)
+            self.thread = None
+
+    def submit(self, stationID, query):
+        if self.interval:
+            self.held[stationID] = query
+        else:
+            self.put(query)
+
+    def put(self, query):
+        try:
+            self.queue.put_nowait(query)
+        except queue.Full:
+            self.dropped += 1
+
+    # Queue the held uploads of the stations whose interval has passed
+    def flush(self, now):
+        for stationID, query in list(self.held.items()):
+            if now - self.sent.get(stationID, 0.0) >= self.interval:
+                del self.held[stationID]
+                self.sent[stationID] = now
+                self.put(query)
+
+    def run(self):
+        while not self.stopping.is_set():
+            query = self.queue.get()
+            if query is None:
+                break
+            for endpoint in self.endpoints:
+                self.forward(endpoint, query)
+        for endpoint in self.endpoints:
+            endpoint.close()
+
+    # Client errors (4xx) are not retried, they will not succeed the next time either
+    def forward(self, endpoint, query):
+        delay = RelayBackoff
+        for attempt in range(RelayRetries + 1):
+            try:
+                status = endpoint.send(query)
+                if status < 400:
+                    self.relayed += 1
+                    return
+                error = "HTTP status %i" % status
+                if status < 500:
+                    break
+            except (OSError, http.client.HTTPException) as e:
+                error = str(e) or e.__class__.__name__
+            if attempt == RelayRetries or self.stopping.wait(delay):
+                break
+            self.retried += 1
+            delay *= 2
+        self.failed += 1
+        self.lastError = "%s: %s" % (endpoint.url, error)
+
+    # Log the failed and dropped uploads since the previous call
+    def report(self):
+        problems = self.failed + self.dropped
+        if problems != self.reported:
+            self.reported = problems
+            logger.error("Relay: %i upload(s) failed, %i dropped, last error: %s", self.failed, self.dropped, self.lastError)
+
+    def snapshot(self):
+        return {
+            "relayed"   : self.relayed,
+            "retried"   : self.retried,
+            "failed"    : self.failed,
+            "dropped"   : self.dropped,
+            "queued"    : self.queue.qsize()
+        }
+
+def ParseEndpoints(text):
+    endpoints = []
+    for url in text.replace(',', ' ').split():
+        try:
+            endpoints.append(RelayEndpoint(url))
+        except ValueError as e:
+            logger.error("%s", str(e))
+    return endpoints
+
+def sensorOptions(device):
+    if device["type"] == "Custom":
+        return { "Custom" : "1;%s" % (device["unit"]) }
+    return None
     
 class BasePlugin:
     enabled = False
     httpServerConn = None
-    httpServerConns = {}
-    httpClientConn = None
     heartbeats = 0
     
     def __init__(self):
+        self.plan = None
+        self.debug = False
+        self.stations = {}
+        self.stationDevices = {}
+        self.ownUnits = set()
+        self.knownStations = set()
+        self.primaryID = None
+        self.primaryStation = None
+        self.allocator = None
+        self.scheduler = DeviceScheduler()
+        self.stats = IngestStats()
+        self.options = {}
+        self.response = BuildResponse(False)
+        self.httpServerConns = collections.OrderedDict()    # Connection.Name -> (Connection, time of last message)
+        self.relay = None
+        self.history = None
+        self.lock = threading.Lock()
+        self.statsLock = threading.Lock()
+        self.queue = None
+        self.worker = None
+        self.unprovisioned = set()      # (station ID, slot index or None, composite position or None) to create on the heartbeat
         return
-        self.Data = {}
 
     def onStart(self):
-        if Parameters["Mode6"] != "Normal":
+        logger.configure(Parameters["Mode6"], Parameters["HomeFolder"])
+        self.debug = logger.isDebug()
+        if Parameters["Mode6"] == "Debug":
             Domoticz.Debugging(1)
             DumpConfigToLog()
         
-        for idx,device in SensorTable.items():
-            if device["name"] != "":
+        self.options = ParseOptions(Parameters["Mode3"])
+        self.response = BuildResponse("minimal" in self.options)
+        self.plan = CompilePlan()
+        self.stations = {}
+        self.primaryStation = None
+        self.scheduler = DeviceScheduler()
+        self.stats = IngestStats()
+        self.primaryID = Parameters["Mode1"].strip() or None
+        
+        # Sensor devices are created on the first value of their key, see provision()
+        if "stats" in self.options:
+            for key,device in StatsSensors.items():
                 if device["nr"] not in Devices:
-                    if (device["type"] == "Custom"):
-                        Domoticz.Device(Name=device["name"], Unit=device["nr"], TypeName=device["type"], Used=1, Options = { "Custom" : "1;%s" % (device["unit"])}).Create()
-                    else:
-                        Domoticz.Device(Name=device["name"], Unit=device["nr"], TypeName=device["type"], Used=1).Create()
+                    createDevice(device["nr"], device["name"], "Custom", { "Custom" : "1;%s" % (device["unit"]) })
         
-        for key,device in CompositeSensors.items():
-            if device["nr"] not in Devices:
-                Domoticz.Device(Name=key, Unit=device["nr"], TypeName=device["type"], Used=1).Create();
+        # Recover the devices of the primary station and of additional stations; units
+        # taken by other stations before the tables reserved them are not the primary's.
+        # Stations are registered from these, so the "ackfirst" worker never reads Devices.
+        self.stationDevices = {}
+        self.ownUnits = set()
+        self.knownStations = set()
+        for unit in Devices:
+            deviceID = str(Devices[unit].DeviceID)
+            if ':' in deviceID:
+                self.stationDevices[deviceID] = unit
+                self.knownStations.add(deviceID.split(':', 1)[0])
+            else:
+                self.ownUnits.add(unit)
+        reserved = set(device["nr"] for table in (SensorTable, WindowSensors, DerivedSensors, CompositeSensors, StatsSensors) for device in table.values())
+        reserved.update(slot.unit for slot in self.plan.slots)
+        self.allocator = UnitAllocator(reserved, set(Devices))
+        devices = len(self.plan.slots) + len(self.plan.composites)
+        logger.info("%i of %i units free for additional stations, enough for %i station(s) with all %i devices",
+            len(self.allocator.free), MaxUnit, len(self.allocator.free) // devices, devices)
+        
+        self.restoreSnapshot()
+        
+        if "history" in self.options:
+            self.history = HistoryStore(os.path.join(Parameters["HomeFolder"], HistoryFolderName), self.plan, parseIntValue(self.options["history"]) or 0)
+            logger.info("Recording history in %s", self.history.folder)
+        
+        endpoints = ParseEndpoints(Parameters["Mode2"])
+        if endpoints:
+            self.relay = Relay(endpoints, parseIntValue(self.options.get("relay")) or 0)
+            self.relay.start()
+            logger.info("Relaying uploads to %s", ", ".join(endpoint.url for endpoint in endpoints))
+        
+        if "ackfirst" in self.options:
+            self.queue = IngestQueue(IngestQueueSize)
+            self.worker = threading.Thread(target=self.work, name="WuDirectIngest")
+            self.worker.daemon = True
+            self.worker.start()
         
         self.httpServerConn = Domoticz.Connection(Name="Server Connection", Transport="TCP/IP", Protocol="HTTP", Port=Parameters["Port"])
         self.httpServerConn.Listen()
-        Domoticz.Log("onStart called")
+        logger.info("onStart called")
+
+    def snapshotPath(self):
+        return os.path.join(Parameters["HomeFolder"], SnapshotFileName)
+
+    def restoreSnapshot(self):
+        started = time.perf_counter()
+        snapshot = LoadSnapshot(self.snapshotPath(), self.plan)
+        if snapshot is None:
+            return
+        # Restore the primary station first, so it claims the original devices again
+        snapshot.sort(key=lambda entry: not entry[1])
+        for stationID, primary, lastSeen, newest, values, windows in snapshot:
+            if primary and self.primaryID is not None and self.primaryID != stationID:
+                continue
+            station = self.getStation(stationID)
+            if station.id != stationID:
+                continue
+            station.lastSeen = lastSeen
+            if newest is not None:
+                station.newest = newest
+                station.recent[newest] = None
+            station.values[:] = values
+            for window, (times, samples) in zip(station.windows, windows):
+                for when, value in zip(times, samples):
+                    window.add(when, value)
+        logger.info("Restored %i station(s) from snapshot in %.1f ms", len(snapshot), (time.perf_counter() - started) * 1000.0)
+
+    def saveSnapshot(self):
+        try:
+            SaveSnapshot(self.snapshotPath(), self.plan, list(self.stations.values()))
+        except OSError as e:
+            logger.error("Snapshot could not be written: %s", str(e))
+
+    # Find the Station for an upload, with the units of the devices it already has
+    # Uploads without ID belong to the primary station, whatever its ID, as only
+    # one Station may write the original devices.
+    def getStation(self, stationID):
+        station = self.stations.get(stationID)
+        if station is not None:
+            return station
+        if stationID == "":
+            if self.primaryStation is not None:
+                return self.primaryStation
+            if self.primaryID is not None:
+                return self.getStation(self.primaryID)
+        
+        plan = self.plan
+        claimable = self.primaryStation is None and self.primaryID is None and stationID not in self.knownStations
+        if claimable or self.primaryID == stationID or stationID == "":
+            if claimable and stationID != "":
+                self.primaryID = stationID
+            station = self.primaryStation = Station(stationID, True,
+                [slot.unit if slot.unit in self.ownUnits else None for slot in plan.slots],
+                [composite.unit if composite.unit in self.ownUnits else None for composite in plan.composites],
+                [window.createWindow() for window in plan.windows])
+        else:
+            station = Station(stationID, False,
+                [self.stationDevices.get(stationDeviceID(stationID, slot.key)) for slot in plan.slots],
+                [self.stationDevices.get(stationDeviceID(stationID, "_" + composite.name)) for composite in plan.composites],
+                [window.createWindow() for window in plan.windows])
+        
+        for slot in plan.slots:
+            if station.sensorUnits[slot.index] is not None:
+                self.scheduler.setInterval(station.sensorUnits[slot.index], slot.interval, slot.deadband)
+        for composite, unit in zip(plan.composites, station.compositeUnits):
+            if unit is not None:
+                self.scheduler.setInterval(unit, composite.interval, composite.deadband)
+        
+        if "spikefilter" in self.options:
+            station.spikes = plan.createSpikeFilters()
+        
+        logger.info("Station %s registered", stationID if stationID != "" else "(no ID)")
+        self.stations[stationID] = station
+        return station
+
+    # Create the device of a plan slot on the first value of its key, returns the unit or 0 when none is free.
+    # The worker of the "ackfirst" option leaves the creation to the heartbeat.
+    def provisionSensor(self, station, slot):
+        if threading.current_thread() is self.worker:
+            self.unprovisioned.add((station.id, slot.index, None))
+            return 0
+        device = slot.device
+        unit = self.provision(station, slot.key, slot.unit, device["name"], device["type"], sensorOptions(device))
+        station.sensorUnits[slot.index] = unit
+        if unit:
+            self.scheduler.setInterval(unit, slot.interval, slot.deadband)
+        return unit
+
+    def provisionComposite(self, station, position):
+        if threading.current_thread() is self.worker:
+            self.unprovisioned.add((station.id, None, position))
+            return 0
+        composite = self.plan.composites[position]
+        unit = self.provision(station, "_" + composite.name, composite.unit, composite.name, CompositeSensors[composite.name]["type"], None)
+        station.compositeUnits[position] = unit
+        if unit:
+            self.scheduler.setInterval(unit, composite.interval, composite.deadband)
+        return unit
+
+    # Create the devices requested by the worker of the "ackfirst" option, with their current value
+    def provisionPending(self, now):
+        if not self.unprovisioned:
+            return
+        pending = self.unprovisioned
+        self.unprovisioned = set()
+        plan = self.plan
+        for stationID, index, position in pending:
+            station = self.stations[stationID]
+            values = station.values
+            if index is not None:
+                if station.sensorUnits[index] is None:
+                    unit = self.provisionSensor(station, plan.slots[index])
+                    if unit and values[index] is not None:
+                        self.scheduler.schedule(unit, "%.1f" % values[index], (values[index],), now)
+            elif station.compositeUnits[position] is None:
+                composite = plan.composites[position]
+                svalue = composite.evaluate(values)
+                unit = self.provisionComposite(station, position)
+                if unit and svalue is not None:
+                    self.scheduler.schedule(unit, svalue, tuple(values[i] for i in composite.sources), now)
+
+    def provision(self, station, key, unit, name, typename, options):
+        if station.primary:
+            if unit in Devices:
+                logger.error("Unit %i for %s is in use by %s", unit, name, Devices[unit].Name)
+                return 0
+            createDevice(unit, name, typename, options)
+            self.ownUnits.add(unit)
+        else:
+            units = self.allocator.allocate(1)
+            if units is None:
+                logger.error("No free unit left for %s of station %s, the %i units of this hardware are used up", name, station.id, MaxUnit)
+                return 0
+            unit = units[0]
+            name = "%s %s" % (name, station.id)
+            deviceID = stationDeviceID(station.id, key)
+            createDevice(unit, name, typename, options, deviceID)
+            self.stationDevices[deviceID] = unit
+        logger.info("Created device %s as unit %i", name, unit)
+        return unit
 
     def onStop(self):
-        Domoticz.Log("onStop called")
+        if self.worker is not None:
+            self.queue.stop()
+            self.worker.join(RelayTimeout)
+            self.worker = None
+        if self.relay is not None:
+            self.relay.stop()
+            self.relay = None
+        self.provisionPending(time.time())
+        self.stats.writes += self.scheduler.flush(time.time(), True)
+        self.flushHistory(time.time())
+        self.saveSnapshot()
+        logger.info("onStop called")
+        logger.flush()
 
     def onConnect(self, Connection, Status, Description):
         if (Status == 0):
-            Domoticz.Log("Connected successfully to: "+Connection.Address+":"+Connection.Port)
+            logger.debug("Connected successfully to: %s:%s", Connection.Address, Connection.Port)
         else:
-            Domoticz.Log("Failed to connect ("+str(Status)+") to: "+Connection.Address+":"+Connection.Port+" with error: "+Description)
-        if (Connection != self.httpClientConn):
-            self.httpServerConns[Connection.Name] = Connection
-        Domoticz.Log("onConnect called")
+            logger.info("Failed to connect (%s) to: %s:%s with error: %s", Status, Connection.Address, Connection.Port, Description)
+        self.trackConnection(Connection, time.time())
+        logger.debug("onConnect called")
+
+    # Move a connection to the end of the table, closing the least recently used above ConnectionLimit
+    def trackConnection(self, Connection, now):
+        conns = self.httpServerConns
+        name = Connection.Name
+        if name in conns:
+            conns.move_to_end(name)
+        conns[name] = (Connection, now)
+        while len(conns) > ConnectionLimit:
+            name, (oldest, seen) = conns.popitem(last=False)
+            self.closeConnection(oldest, "connection limit reached")
+
+    # Close the connections without a message for ConnectionIdleTimeout seconds
+    def evictConnections(self, now):
+        conns = self.httpServerConns
+        while conns:
+            name, (oldest, seen) = next(iter(conns.items()))
+            if now - seen <= ConnectionIdleTimeout:
+                break
+            del conns[name]
+            self.closeConnection(oldest, "idle")
+
+    def closeConnection(self, Connection, reason):
+        self.stats.evicted += 1
+        logger.debug("Closing connection %s:%s, %s", Connection.Address, Connection.Port, reason)
+        Connection.Disconnect()
 
     def onMessage(self, Connection, Data):
-        Domoticz.Log("onMessage called for connection: "+Connection.Address+":"+Connection.Port)
-        if Parameters["Mode6"] != "Normal":
-            Domoticz.Log("URL CALLED: " + Data["URL"])
-        parsed = urlparse.urlparse(Data["URL"])
-        paramdict = urlparse.parse_qs(parsed.query)
+        stats = self.stats
+        clock = time.perf_counter
+        started = clock()
+        debug = self.debug
+        self.trackConnection(Connection, time.time())
+        if debug:
+            logger.debug("onMessage called for connection: %s:%s", Connection.Address, Connection.Port)
+            logger.debug("URL CALLED: %s", Data["URL"])
+        logged = clock()
+        path, _, query = Data["URL"].partition('?')
+        # Unknown parameters are only parsed to report them in debug mode
+        record = parseQuery(query, None if debug else self.plan.keys)
+        parsed = clock()
         
-        self.Data = {}
+        if path == StatsPath:
+            self.countMessage(logged - started, parsed - logged)
+            snapshot = stats.snapshot()
+            if self.relay is not None:
+                snapshot["relay"] = self.relay.snapshot()
+            if self.queue is not None:
+                snapshot["queue"] = self.queue.snapshot()
+            if self.history is not None:
+                snapshot["history"] = self.history.snapshot()
+            Connection.Send({"Status":"200 OK", "Headers": {"Connection": "keep-alive", "Content-Type": "application/json"}, "Data": json.dumps(snapshot)})
+            return
+        if path == HistoryPath:
+            self.countMessage(logged - started, parsed - logged)
+            self.sendHistory(Connection, query)
+            return
         
-        for key,param in paramdict.items():
-            value = param[0]
-            if key in SensorTable:                
-                device = SensorTable[key]
-                
-                if (device["name"] != "") :                
-                    unitnr = device["nr"]
-                    scale  = device["scale"]
-                    offset = device["offset"]
-                    minval = device["min"]
-                    maxval = device["max"]
-                    self.Data[key] = None
-                    if Parameters["Mode6"] != "Normal":
-                        Domoticz.Log("Updating sensor: %s (Scale %.3f, offset %.3f" % (str(unitnr),scale,offset))
-                    try:
-                        if (is_number(value)):
-                            fvalue = float(value) * scale + offset
-                            if (fvalue >= minval and fvalue <= maxval):
-                                svalue = "%.1f" % fvalue
-                                UpdateDevice(unitnr,0,svalue)
-                                svalue = "%.6f" % fvalue
-                                self.Data[key] = svalue
-                            else:
-                                Domoticz.Log("Sensor value for device %i out of range and discarded: %.1f" % (unitnr, fvalue))
-                        else:
-                            Domoticz.Log("Sensor value for device %i NOT numeric: %s" % (unitnr, str(value)))
-                            # UpdateDevice(unitnr,0,value)
-                            self.Data[key] = None
-                    except:
-                        Domoticz.Log("Sensor update EXCEPTION for unit %i" % unitnr)
-                else:
-                    if Parameters["Mode6"] != "Normal":
-                        Domoticz.Log("Sensor NOT handled in code: %s" % (key))
-            else:
-                if Parameters["Mode6"] != "Normal":
-                    Domoticz.Log("Sensor NOT found: %s" % (key))
-                
-        for key,device in CompositeSensors.items():
-            unitnr = device["nr"]
-            data_lst = []
-            value = None
-            for src in device["src"]:                
-                if (src[0] == '_'):
-                    function,paramstr = src[1:].split(',',1)
-                    params = paramstr.split(',')
-                    if None in params:
-                        continue
-                    if (function == 'forecast'):
-                        paramval = parseFloatValue(self.Data[params[0]])
-                        if paramval != None:
-                            value = str(getBarometerForecast(paramval))
-                        else:
-                            value = None
-                    elif (function == 'humstat'):
-                        param0val = parseFloatValue(self.Data[params[0]])
-                        param1val = parseFloatValue(self.Data[params[1]])
-                        if param0val != None and param1val != None:
-                            value = str (getHumidityStatus(param0val,param1val))
-                        else:
-                            value = None
-                    elif (function == 'winddir'):
-                        paramval = parseFloatValue(self.Data[params[0]])
-                        if paramval != None:
-                            value = getWindDirection(paramval)
-                        else:
-                            value = None                            
-                    elif (function == 'rain100'):
-                        rain = parseFloatValue(self.Data[params[0]])
-                        if rain != None:
-                            value = floatToString(rain * 100.0 )
-                        else:
-                            value = None
-                    elif (function == 'windms10'):
-                        wind = parseFloatValue(self.Data[params[0]])
-                        if wind != None:
-                            value = floatToString(wind * 10.0 /3.6 )
-                        else:
-                            value = None
-                else:
-                    if src in self.Data:
-                        value = self.Data[src]
-                        if (is_number(value)):
-                            fvalue = float(value)
-                            value = "%.1f" % fvalue
-                if (value !=  None and type(value) == str):
-                    data_lst.append( value )
-
-            if len(data_lst) == len(device["src"]):   # exactly right amount of values?
-                svalue = ';'.join(data_lst)
-                UpdateDevice(unitnr,0,svalue)
+        body = Data.get("Data") if Data.get("Verb") == "POST" else None
+        if not IsUpload(self.plan, record, body):
+            if debug:
+                logger.debug("No sensor values in request for %s, ignored", path)
+            responded = self.respond(Connection, Data)
+        elif self.queue is None:
+            self.process(record, query, body)
+            responded = self.respond(Connection, Data)
+        else:
+            responded = self.respond(Connection, Data)
+            self.queue.put((record, query, body))
+        self.countMessage(logged - started + responded, parsed - logged)
+
+    # The counters of onMessage are shared with the worker of the "ackfirst" option.
+    # They have their own lock, so the acknowledgement never waits for the worker.
+    def countMessage(self, logTime, parseTime):
+        stats = self.stats
+        with self.statsLock:
+            stats.messages += 1
+            stats.logTime += logTime
+            stats.parseTime += parseTime
+
+    # Worker thread of the "ackfirst" option
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            with self.lock:
+                try:
+                    self.process(*item)
+                except Exception as e:
+                    logger.error("Upload could not be processed: %s", str(e))
+
+    # Handle the parsed query and, for a POST, the body of an upload
+    def process(self, record, query, body):
+        stats = self.stats
+        if body:
+            clock = time.perf_counter
+            started = clock()
+            records = parseBatch(body, record)
+            elapsed = clock() - started
+            with self.statsLock:
+                stats.parseTime += elapsed
+            if records is None:
+                logger.error("Batch upload could not be parsed, %i bytes ignored", len(body))
             else:
-                Domoticz.Log("Device %s expected %i parameters but received %i." % (key, len(src), len(data_lst)))
+                logger.debug("Batch upload with %i records received.", len(records))
+                IngestRecords(self, records, True)
+        elif IngestRecords(self, [record], False):
+            if self.relay is not None and query != "":
+                self.relay.submit(record.get("ID", ""), query)
         
         # EXAMPLE URL:
         # /weatherstation/updateweatherstation.php?ID=IXXXXXX&PASSWORD=NoKeyNeeded&indoortempf=72.9&tempf=66.9&dewptf=63.0&windchillf=66.9&indoorhumidity=65&humidity=87&windspeedmph=1.6&windgustmph=2.2&winddir=196&absbaromin=29.740&baromin=29.918&rainin=0.000&dailyrainin=0.059&weeklyrainin=1.220&monthlyrainin=1.500&solarradiation=86.73&UV=0&dateutc=2019-08-17%2012:42:23&softwaretype=EasyWeatherV1.4.1&action=updateraw&realtime=1&rtfreq=5
-        
-        # Incoming Requests
+
+    # Incoming Requests, returns the seconds spent
+    def respond(self, Connection, Data):
+        clock = time.perf_counter
+        started = clock()
         if "Verb" in Data:
             strVerb = Data["Verb"]
-            LogMessage(strVerb+" request received.")
-            data = "<!doctype html><html><head></head><body><h1>Successful GET!!!</h1></body></html>"
-            if (strVerb == "GET"):
-                Connection.Send({"Status":"200 OK", "Headers": {"Connection": "keep-alive", "Accept": "Content-Type: text/html; charset=UTF-8"}, "Data": data})
-            elif (strVerb == "POST"):
-                Connection.Send({"Status":"200 OK", "Headers": {"Connection": "keep-alive", "Accept": "Content-Type: text/html; charset=UTF-8"}, "Data": data})
+            if self.debug:
+                logger.debug("%s request received.", strVerb)
+            if (strVerb == "GET" or strVerb == "POST"):
+                Connection.Send(self.response)
             else:
-                Domoticz.Error("Unknown verb in request: "+strVerb)    
-        Domoticz.Log("onMessage called")
+                logger.error("Unknown verb in request: %s", strVerb)
+        return clock() - started
+
+    # Count a retransmitted (duplicate) or stale upload, see CheckOrder
+    def countOrder(self, station, order, dateutc):
+        if order == RecordDuplicate:
+            self.stats.duplicates += 1
+            logger.debug("Duplicate upload of station %s at %s dropped", station.id, dateutc)
+        else:
+            self.stats.stale += 1
+            logger.debug("Upload of station %s at %s is older than the newest upload", station.id, dateutc)
+
+    # Convert one upload record (parameter -> value) and update the devices of its
+    # station, called by IngestRecords. See SampleRecord for sample and when.
+    def ingest(self, record, sample=True, when=None):
+        debug = self.debug
+        plan = self.plan
+        stats = self.stats
+        stats.records += 1
+        clock = time.perf_counter
+        started = clock()
+        
+        station = self.getStation(str(record.get("ID", "")))
+        sensorUnits = station.sensorUnits
+        values = station.values
+        scheduler = self.scheduler
+        now = time.time()
+        station.lastSeen = now
+        if station.timedOut and threading.current_thread() is not self.worker:
+            self.resumeStation(station)
+        
+        converted = SampleRecord(self, station, record, sample, when, now, debug)
+        for converter in converted:
+            unitnr = sensorUnits[converter.index]
+            if unitnr is None:
+                unitnr = self.provisionSensor(station, converter)
+            if not unitnr:
+                continue
+            if debug:
+                logger.debug("Updating sensor: %s (unit %i)", converter.key, unitnr)
+            fvalue = values[converter.index]
+            scheduler.schedule(unitnr,"%.1f" % fvalue,(fvalue,),now)
+        
+        finished = clock()
+        stats.convertTime += finished - started
+        
+        # Only composites with a changed input are evaluated, the other inputs
+        # keep their last known good value
+        compositeUnits = station.compositeUnits
+        for position in plan.affected(converted):
+            composite = plan.composites[position]
+            svalue = composite.evaluate(values)
+            if svalue is not None:
+                unitnr = compositeUnits[position]
+                if unitnr is None:
+                    unitnr = self.provisionComposite(station, position)
+                if not unitnr:
+                    continue
+                scheduler.schedule(unitnr,svalue,tuple(values[i] for i in composite.sources),now)
+            elif debug:
+                logger.debug("Device %s is waiting for the first value of all of its %i parameters.", composite.name, len(composite.parts))
+        stats.compositeTime += clock() - finished
+
+    def rejectSensor(self, key, value, reason):
+        if reason == RejectOutOfRange:
+            self.stats.outOfRange += 1
+            logger.info("Sensor value for %s out of range and discarded: %.1f", key, value)
+        elif reason == RejectNotNumeric:
+            self.stats.notNumeric += 1
+            logger.info("Sensor value for %s NOT numeric: %s", key, value)
+        elif reason == RejectSpike:
+            self.stats.spikes += 1
+            logger.info("Sensor value for %s is a spike and discarded: %.1f", key, value)
+        elif reason == RejectUnhandled:
+            logger.debug("Sensor NOT handled in code: %s", key)
+        else:
+            logger.debug("Sensor NOT found: %s", key)
 
     def onCommand(self, Unit, Command, Level, Hue):
-        Domoticz.Log("onCommand called for Unit " + str(Unit) + ": Parameter '" + str(Command) + "', Level: " + str(Level))
+        logger.info("onCommand called for Unit %s: Parameter '%s', Level: %s", Unit, Command, Level)
 
     def onNotification(self, Name, Subject, Text, Status, Priority, Sound, ImageFile):
-        Domoticz.Log("Notification: " + Name + "," + Subject + "," + Text + "," + Status + "," + str(Priority) + "," + Sound + "," + ImageFile)
+        logger.info("Notification: %s,%s,%s,%s,%s,%s,%s", Name, Subject, Text, Status, Priority, Sound, ImageFile)
 
     def onDisconnect(self, Connection):
-        if Connection.Name in self.httpServerConns:
-            del self.httpServerConns[Connection.Name]    
-        Domoticz.Log("onDisconnect called")
+        self.httpServerConns.pop(Connection.Name, None)
+        logger.debug("onDisconnect called")
 
     def onHeartbeat(self):
-        if (self.httpClientConn == None or self.httpClientConn.Connected() != True):
-            self.httpClientConn = Domoticz.Connection(Name="Client Connection", Transport="TCP/IP", Protocol="HTTP", Address="127.0.0.1", Port=Parameters["Port"])
-            self.httpClientConn.Connect()
-            self.heartbeats = 0
+        with self.lock:
+            self.heartbeat()
 
-        self.heartbeats += 1    
+    def heartbeat(self):
+        self.heartbeats += 1
+        now = time.time()
+        self.provisionPending(now)
+        started = time.perf_counter()
+        self.stats.writes += self.scheduler.flush(now)
+        self.stats.updateTime += time.perf_counter() - started
+        self.checkStations(now)
+        self.evictConnections(now)
+        if self.relay is not None:
+            self.relay.flush(now)
+            self.relay.report()
+        if self.history is not None and self.heartbeats % HistoryHeartbeats == 0:
+            self.flushHistory(now)
+        if self.heartbeats % SnapshotHeartbeats == 0:
+            self.saveSnapshot()
+        logger.flush()
+        if "stats" in self.options and self.heartbeats % StatsHeartbeats == 0:
+            self.updateStats(now)
         # Domoticz.Log("onHeartbeat called")
 
+    def flushHistory(self, now):
+        if self.history is None:
+            return
+        try:
+            self.history.flush(now)
+        except OSError as e:
+            logger.error("History could not be written: %s", str(e))
+
+    # Answer GET /history?ID=<station>&key=<sensor key>&start=<epoch>&end=<epoch>&step=<seconds>
+    # with the min, mean and max per step of the recorded readings
+    def sendHistory(self, Connection, query):
+        headers = {"Connection": "keep-alive", "Content-Type": "application/json"}
+        if self.history is None:
+            Connection.Send({"Status":"404 Not Found", "Headers": headers, "Data": json.dumps({"error": "history is not enabled"})})
+            return
+        args = parseQuery(query)
+        stationID = args.get("ID", self.primaryID or "")
+        key = args.get("key")
+        now = time.time()
+        end = parseFloatValue(args.get("end")) or now
+        start = parseFloatValue(args.get("start")) or end - HistoryDefaultSpan
+        step = parseFloatValue(args.get("step")) or HistoryDefaultStep
+        error = None
+        if key not in self.history.keys:
+            error = "unknown key: %s" % key
+        elif not (math.isfinite(start) and math.isfinite(end) and math.isfinite(step)):
+            error = "start, end and step must be finite numbers"
+        elif step <= 0 or end <= start:
+            error = "empty range"
+        elif (end - start) / step > HistoryMaxBuckets:
+            error = "more than %i buckets" % HistoryMaxBuckets
+        if error is not None:
+            Connection.Send({"Status":"400 Bad Request", "Headers": headers, "Data": json.dumps({"error": error})})
+            return
+        with self.lock:
+            self.flushHistory(now)
+        started = time.perf_counter()
+        buckets = self.history.query(stationID, key, start, end, step)
+        logger.debug("History of %s %s: %i bucket(s) in %.1f ms", stationID, key, len(buckets), (time.perf_counter() - started) * 1000.0)
+        result = {
+            "ID"        : stationID,
+            "key"       : key,
+            "start"     : start,
+            "end"       : end,
+            "step"      : step,
+            "buckets"   : [[when, count, low, round(mean, 3), high] for when, count, low, mean, high in buckets]
+        }
+        Connection.Send({"Status":"200 OK", "Headers": headers, "Data": json.dumps(result)})
+
+    def updateStats(self, now):
+        rates = self.stats.rates(now)
+        if rates is None:
+            return
+        for key,device in StatsSensors.items():
+            UpdateDevice(device["nr"], 0, "%.1f" % rates[key])
+
+    # Mark the devices of stations that stopped uploading as timed out, and of
+    # stations that upload again as not timed out. A unit written by a station
+    # that still uploads is never timed out.
+    def checkStations(self, now):
+        live = set()
+        for station in self.stations.values():
+            if now - station.lastSeen <= StationTimeout:
+                live.update(station.units())
+        for station in self.stations.values():
+            if not station.timedOut and now - station.lastSeen > StationTimeout:
+                station.timedOut = True
+                logger.info("Station %s has not uploaded for %i seconds, devices timed out", station.id, now - station.lastSeen)
+                for unit in station.units():
+                    if unit not in live:
+                        SetTimedOut(unit, 1)
+            elif station.timedOut and now - station.lastSeen <= StationTimeout:
+                self.resumeStation(station)
+
+    def resumeStation(self, station):
+        station.timedOut = False
+        logger.info("Station %s is uploading again", station.id)
+        for unit in station.units():
+            SetTimedOut(unit, 0)
+
 global _plugin
 _plugin = BasePlugin()
 
@@ -472,16 +2623,6 @@ def onHeartbeat():
     _plugin.onHeartbeat()
 
 # Generic helper functions
-def LogMessage(Message):
-    if Parameters["Mode6"] != "Normal":
-        Domoticz.Log(Message)
-    elif Parameters["Mode6"] != "Debug":
-        Domoticz.Debug(Message)
-    else:
-        f = open("http.html","w")
-        f.write(Message)
-        f.close()   
-
 def DumpConfigToLog():
     for x in Parameters:
         if Parameters[x] != "":
@@ -503,6 +2644,220 @@ def UpdateDevice(Unit, nValue, sValue, AlwaysUpdate=False):
         if Devices[Unit].nValue != nValue or Devices[Unit].sValue != sValue or AlwaysUpdate == True:
             Devices[Unit].Update(nValue, str(sValue))
             # Domoticz.Log("Update " + Devices[Unit].Name + ": " + str(nValue) + " - '" + str(sValue) + "'")
+            return True
+    return False
+
+#
+# Parse a query string into a dict, keeping the first value of every parameter.
+# The string is scanned once; with keys given, only those parameters are kept, so
+# PASSWORD, softwaretype and the like are skipped without decoding. Only values
+# containing '%' or '+' are unquoted. Empty values are skipped, as by parse_qsl.
+#
+def parseQuery(query, keys=None):
+    record = {}
+    for item in query.split('&'):
+        key, _, value = item.partition('=')
+        if value == "":
+            continue
+        if '%' in key or '+' in key:
+            key = urlparse.unquote_plus(key)
+        if keys is not None and key not in keys:
+            continue
+        if key not in record:
+            if '%' in value or '+' in value:
+                value = urlparse.unquote_plus(value)
+            record[key] = value
+    return record
+
+#
+# Parse the body of a batch upload. Accepted formats are a JSON array of objects,
+# a JSON object with a "records" array, newline-delimited JSON objects, or
+# newline-delimited query strings (optionally with the URL path in front).
+# Parameters of the request URL are used as defaults for every record.
+# Returns None when the body cannot be parsed.
+#
+def parseBatch(body, defaults):
+    if isinstance(body, (bytes, bytearray)):
+        body = body.decode("utf-8", "replace")
+    body = body.strip()
+    records = []
+    try:
+        if body[:1] in ('[', '{'):
+            try:
+                parsed = json.loads(body)
+            except ValueError:
+                parsed = [json.loads(line) for line in body.splitlines() if line.strip() != ""]
+            if isinstance(parsed, dict):
+                parsed = parsed.get("records", [parsed])
+            if not isinstance(parsed, list):
+                return None
+            for item in parsed:
+                if not isinstance(item, dict):
+                    return None
+                record = dict(defaults)
+                record.update(item)
+                records.append(record)
+        else:
+            for line in body.splitlines():
+                line = line.strip()
+                if line == "":
+                    continue
+                record = dict(defaults)
+                record.update(parseQuery(line.split('?', 1)[1] if '?' in line else line))
+                records.append(record)
+    except ValueError:
+        return None
+    return records
+
+# An upload holds a batch or at least one sensor value. Other requests, like a
+# browser asking for /favicon.ico or a health check, must not register a station.
+def IsUpload(plan, record, body):
+    return bool(body) or not plan.sensors.keys().isdisjoint(record)
+
+#
+# Group the records of a batch per station. Records are ordered on dateutc when
+# all records of a station carry one, otherwise the order of arrival is used.
+#
+def GroupRecords(records):
+    stations = {}
+    for record in records:
+        stations.setdefault(str(record.get("ID", "")), []).append(record)
+    groups = []
+    for stationRecords in stations.values():
+        if all(str(record.get("dateutc", "now")) != "now" for record in stationRecords):
+            stationRecords.sort(key=lambda record: str(record["dateutc"]))
+        groups.append(stationRecords)
+    return groups
+
+# Merge the ordered records of one station, the newest value of every parameter wins
+def FoldGroup(stationRecords):
+    merged = {}
+    for record in stationRecords:
+        merged.update(record)
+    return merged
+
+#
+# Parse a WU dateutc value ("2019-08-17 12:42:23") into seconds since the epoch,
+# None for "now" or an unreadable value
+#
+def parseDateUTC(value):
+    if value is None or value == "now":
+        return None
+    try:
+        return float(calendar.timegm(time.strptime(str(value), "%Y-%m-%d %H:%M:%S")))
+    except ValueError:
+        return None
+
+# Time of a reading in the rolling windows and the history: its dateutc, but not
+# later than now, so uploads with and without a (skewed) dateutc share one clock
+def SampleTime(when, now):
+    if when is None or when > now:
+        return now
+    return when
+
+#
+# Ingest flow of the records of one request. This does not depend on Domoticz
+# and is shared with the standalone server. pipeline provides:
+#   plan, history                       the IngestPlan and a HistoryStore or None
+#   getStation(stationID)               the Station of an upload
+#   rejectSensor(key, value, reason)    a rejected value, see ConvertRecord
+#   countOrder(station, order, dateutc) a duplicate or stale upload
+#   ingest(record, sample, when)        the update of one fresh record, using SampleRecord
+# The records of a batch are ordered per station. Every record that is not a
+# retransmission goes into the history and the spike filters and, when in order,
+# into the rolling windows at its own dateutc, see AggregateRecord. The fresh
+# records of a station are then folded into one update. A single upload is
+# ingested when fresh, a stale one only goes into the history.
+# Returns the number of updates passed to ingest().
+#
+def IngestRecords(pipeline, records, batch):
+    ingested = 0
+    if batch:
+        for stationRecords in GroupRecords(records):
+            fresh = []
+            for record in stationRecords:
+                order, when = CheckOrder(pipeline, record)
+                if order != RecordDuplicate:
+                    AggregateRecord(pipeline, record, when, order == RecordFresh)
+                    if order == RecordFresh:
+                        fresh.append(record)
+            if fresh:
+                pipeline.ingest(FoldGroup(fresh), False, None)
+                ingested += 1
+    else:
+        for record in records:
+            order, when = CheckOrder(pipeline, record)
+            if order == RecordFresh:
+                pipeline.ingest(record, True, when)
+                ingested += 1
+            elif order == RecordStale and pipeline.history is not None:
+                AggregateRecord(pipeline, record, when, False)
+    return ingested
+
+# Drop retransmitted uploads, and keep readings older than the newest upload of
+# the station away from the devices. Returns the order and the dateutc in seconds
+# since the epoch, None for "now".
+def CheckOrder(pipeline, record):
+    dateutc = record.get("dateutc")
+    if dateutc is None or dateutc == "now":
+        return RecordFresh, None
+    station = pipeline.getStation(str(record.get("ID", "")))
+    when = parseDateUTC(dateutc)
+    order = station.checkOrder(when)
+    if order != RecordFresh:
+        pipeline.countOrder(station, order, dateutc)
+    return order, when
+
+# Feed one record into the rolling windows and the history of its station, at
+# its dateutc (when, as returned by CheckOrder), see SampleTime. A stale record
+# (fresh False) only goes into the history, the windows only take samples in order.
+# Rejected values (including spikes) are reported and removed from the record,
+# so the batch fold passed to ingest() holds checked values only.
+def AggregateRecord(pipeline, record, when=None, fresh=True):
+    plan = pipeline.plan
+    history = pipeline.history
+    windows = fresh and plan.windows
+    station = pipeline.getStation(str(record.get("ID", "")))
+    if not windows and history is None and station.spikes is None:
+        return
+    values = [None] * plan.size
+    rejected = []
+    def reject(key, value, reason):
+        rejected.append(key)
+        pipeline.rejectSensor(key, value, reason)
+    converted = ConvertRecord(plan, record, values, reject, False, station.spikes)
+    for key in rejected:
+        del record[key]
+    when = SampleTime(when, time.time())
+    if history is not None:
+        history.append(station.id, converted, values, when)
+    if windows:
+        station.sample(plan, converted, values, when)
+
+# Convert one record into the last known values of its station, and update the
+# history, the rolling windows and the derived sensors. With sample False the
+# windows, the history and the spike filters were already fed by AggregateRecord.
+# The windows and the history get the reading at when, the dateutc returned by
+# CheckOrder, or now, see SampleTime. Returns the slots with a new value.
+def SampleRecord(pipeline, station, record, sample, when, now, verbose=False):
+    plan = pipeline.plan
+    history = pipeline.history
+    values = station.values
+    converted = ConvertRecord(plan, record, values, pipeline.rejectSensor, verbose, station.spikes if sample else None)
+    when = SampleTime(when, now)
+    if history is not None and sample and converted:
+        history.append(station.id, converted, values, when)
+    if plan.windows:
+        converted += station.sample(plan, converted, values, when, sample)
+    if plan.derived:
+        converted += DeriveValues(plan, converted, values)
+    return converted
+
+# Set or clear the timed out state of a device, keeping its values
+def SetTimedOut(Unit, TimedOut):
+    if Unit in Devices:
+        if Devices[Unit].TimedOut != TimedOut:
+            Devices[Unit].Update(nValue=Devices[Unit].nValue, sValue=Devices[Unit].sValue, TimedOut=TimedOut)
     return
 
 def is_number(s):
@@ -543,10 +2898,86 @@ def getWindChill(temperature,windSpeed):
     return windChill
 
 
+#
+# Heat index (NOAA), temperature in Celsius and relative humidity in %.
+# The simple Steadman formula is used below 80 F, the Rothfusz regression above.
+#
+def getHeatIndex(temperature, humidity):
+
+    if temperature == None or humidity == None:
+        return None
+
+    t = temperature * 1.8 + 32.0
+    heatIndex = 0.5 * (t + 61.0 + (t - 68.0) * 1.2 + humidity * 0.094)
+    if (heatIndex + t) / 2.0 >= 80.0:
+        heatIndex = (-42.379 + 2.04901523 * t + 10.14333127 * humidity - 0.22475541 * t * humidity
+            - 0.00683783 * t * t - 0.05481717 * humidity * humidity + 0.00122874 * t * t * humidity
+            + 0.00085282 * t * humidity * humidity - 0.00000199 * t * t * humidity * humidity)
+        if humidity < 13 and 80.0 <= t <= 112.0:
+            heatIndex -= ((13.0 - humidity) / 4.0) * math.sqrt((17.0 - abs(t - 95.0)) / 17.0)
+        elif humidity > 85 and 80.0 <= t <= 87.0:
+            heatIndex += ((humidity - 85.0) / 10.0) * ((87.0 - t) / 5.0)
+    return round((heatIndex - 32.0) / 1.8, 1)
+
+
+#
+# Apparent temperature (Steadman, as used by the Australian Bureau of Meteorology),
+# temperature in Celsius, relative humidity in % and wind speed in m/s
+#
+def getApparentTemperature(temperature, humidity, windSpeed):
+
+    if temperature == None or humidity == None or windSpeed == None:
+        return None
+
+    vapourPressure = humidity / 100.0 * 6.105 * math.exp(17.27 * temperature / (237.7 + temperature))
+    return round(temperature + 0.33 * vapourPressure - 0.70 * windSpeed - 4.00, 1)
+
+
+#
+# Dew point (Magnus formula), temperature in Celsius and relative humidity in %
+#
+def getDewPoint(temperature, humidity):
+
+    if temperature == None or humidity == None or humidity <= 0:
+        return None
+
+    gamma = math.log(humidity / 100.0) + 17.62 * temperature / (243.12 + temperature)
+    return round(243.12 * gamma / (17.62 - gamma), 1)
+
+
 # From: buienradar.py
 #
-# Convert the wind direction to a (English) abbreviation
+# Convert the wind direction to a (English) abbreviation. WindSectors holds the
+# highest bearing (inclusive) and the name of every sector, clockwise from north.
+# The sectors are compiled into WindDirections, a lookup of the name per whole
+# degree 0..360. A sector holds the bearings above the previous bound, so a
+# fractional bearing has the sector of its ceiling.
 #
+WindSectors = [
+    ( 11, "N"),
+    ( 33, "NNE"),
+    ( 57, "NE"),
+    ( 78, "ENE"),
+    (102, "E"),
+    (123, "ESE"),
+    (157, "SE"),
+    (168, "SSE"),
+    (192, "S"),
+    (213, "SSW"),
+    (237, "SW"),
+    (258, "WSW"),
+    (282, "W"),
+    (303, "WNW"),
+    (327, "NW"),
+    (348, "NNW"),
+    (360, "N")
+]
+
+def CompileWindDirections(sectors):
+    bounds = [bound for bound, name in sectors]
+    return tuple(sectors[bisect.bisect_left(bounds, degree)][1] for degree in range(0, 361))
+
+WindDirections = CompileWindDirections(WindSectors)
 
 def getWindDirection(windBearing):
 
@@ -556,51 +2987,53 @@ def getWindDirection(windBearing):
     if windBearing < 0 or windBearing > 360:
         return ""
 
-    if windBearing > 348 or  windBearing <=  11:
-        return "N"
-    if windBearing >  11 and windBearing <=  33:
-        return "NNE"
-    if windBearing >  33 and windBearing <=  57:
-        return "NE"
-    if windBearing >  57 and windBearing <=  78:
-        return "ENE"
-    if windBearing >  78 and windBearing <= 102:
-        return "E"
-    if windBearing > 102 and windBearing <= 123:
-        return "ESE"
-    if windBearing > 123 and windBearing <= 157:
-        return "SE"
-    if windBearing > 157 and windBearing <= 168:
-        return "SSE"
-    if windBearing > 168 and windBearing <= 192:
-        return "S"
-    if windBearing > 192 and windBearing <= 213:
-        return "SSW"
-    if windBearing > 213 and windBearing <= 237:
-        return "SW"
-    if windBearing > 237 and windBearing <= 258:
-        return "WSW"
-    if windBearing > 258 and windBearing <= 282:
-        return "W"
-    if windBearing > 282 and windBearing <= 303:
-        return "WNW"
-    if windBearing > 303 and windBearing <= 327:
-        return "NW"
-    if windBearing > 327 and windBearing <= 348:
-        return "NNW"
-
-    # just in case
-    return ""
+    return WindDirections[math.ceil(windBearing)]
 
 
-# From: buienradar.py
-# Based on various pictures of analogue barometers found in the Internet
 #
-def getBarometerForecast(pressure):
+# Forecast from the pressure, adjusted for the pressure tendency (the change in
+# hPa over 3 hours) when it is known
+#
+def getBarometerForecast(pressure, tendency=None):
 
     if pressure == None:
         return 5
 
+    forecast = getPressureForecast(pressure)
+
+    # No tendency known yet, use the pressure only
+    if tendency == None:
+        return forecast
+
+    # Falling quickly
+    if tendency <= TendencyFallingFast:
+        return 4 if pressure < TendencyStormPressure else 6
+
+    # Falling or rising, one step worse or better
+    step = ForecastOrder.index(forecast)
+    if tendency <= -TendencySteady:
+        return ForecastOrder[max(step - 1, 0)]
+    if tendency >= TendencySteady:
+        return ForecastOrder[min(step + 1, len(ForecastOrder) - 1)]
+
+    return forecast
+
+
+# Forecasts ordered from worst to best weather
+ForecastOrder = (4, 6, 2, 3, 0, 1)
+
+# Tendency in hPa per 3 hours within which the pressure is steady, at or below
+# TendencyFallingFast the forecast is thunderstorm below TendencyStormPressure
+# and rain above it
+TendencySteady        = 1.0
+TendencyFallingFast   = -3.0
+TendencyStormPressure = 1000
+
+# From: buienradar.py
+# Based on various pictures of analogue barometers found in the Internet
+#
+def getPressureForecast(pressure):
+
     # Thunderstorm = 4
     if pressure < 966:
         return 4
@@ -630,24 +3063,38 @@ def getBarometerForecast(pressure):
 # These values are normally used for indoor situation,
 # but this weather lookup plugin obviously is outdoor.
 #
+# Humidity at or below 'dry' is dry (2), at or above 'wet' is wet (3), and
+# within the comfortable humidity and temperature ranges it is comfortable (1).
+# The limits are read into constants, so the comparisons cost the same as
+# with literal values.
+#
+HumidityClasses = {
+    'dry'        : 30,
+    'wet'        : 70,
+    'comfort'    : (35, 65),
+    'comforttemp': (22, 26)
+}
+
+HumidityDry = HumidityClasses['dry']
+HumidityWet = HumidityClasses['wet']
+HumidityComfortLow, HumidityComfortHigh         = HumidityClasses['comfort']
+HumidityComfortTempLow, HumidityComfortTempHigh = HumidityClasses['comforttemp']
+
 def getHumidityStatus(humidity,temperature):
 
     # Is there a humidity?
     if humidity == None:
         return 0
 
-    # Dry?
-    if humidity <= 30:
+    if humidity <= HumidityDry:
         return 2
-
-    # Wet?
-    if humidity >= 70:
+    if humidity >= HumidityWet:
         return 3
 
     # Comfortable?
-    if humidity >= 35 and humidity <= 65:
+    if humidity >= HumidityComfortLow and humidity <= HumidityComfortHigh:
         if temperature != None:
-            if temperature >= 22 and temperature <= 26:
+            if temperature >= HumidityComfortTempLow and temperature <= HumidityComfortTempHigh:
                 return 1
 
     # Normal
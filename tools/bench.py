@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+#
+# Offline benchmark of BasePlugin.onMessage
+#
+# Replays a corpus of Wunderground upload URLs through onStart and onMessage of
+# plugin.py in the Domoticz stand-in, and reports the throughput, the latency
+# percentiles per call and the number of device Update calls.
+#
+# Usage:
+#   python3 tools/bench.py [--corpus tools/corpus.txt] [--messages 20000] [--stations 1]
+#
+
+import argparse
+import os
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import domoticz_stub
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+def stationURLs(corpus, stations):
+    if stations <= 1:
+        return corpus
+    urls = []
+    for index, url in enumerate(corpus):
+        for station in range(stations):
+            urls.append(url.replace("ID=I", "ID=S%03i" % station, 1))
+    return urls
+
+
+# The plugin drops uploads with a dateutc it has seen, so every replayed
+# message gets its own, increasing dateutc
+def freshDates(urls, messages):
+    count = len(urls)
+    start = int(time.time()) - messages
+    return [re.sub(r"dateutc=(?!now)[^&]*", "dateutc=" + time.strftime("%Y-%m-%d%%20%H:%M:%S", time.gmtime(start + index)), urls[index % count], 1)
+        for index in range(messages)]
+
+
+# The plugin home folder (log file, snapshot and history) is a fresh temporary folder,
+# a snapshot of an earlier run would make the replayed uploads stale
+def bench(args):
+    with tempfile.TemporaryDirectory() as folder:
+        parameters = dict(args.parameters)
+        parameters.setdefault("HomeFolder", os.path.join(folder, ""))
+        run(args, parameters)
+
+
+def run(args, parameters):
+    env = domoticz_stub.load(Parameters=parameters)
+    plugin = env.plugin
+    urls = stationURLs(domoticz_stub.readCorpus(args.corpus), args.stations)
+    messages = freshDates(urls, args.messages)
+
+    started = time.perf_counter()
+    plugin.onStart()
+    startup = time.perf_counter() - started
+
+    connection = domoticz_stub.Connection()
+    plugin.onConnect(connection, 0, "")
+
+    # Warm up, so device creation is not part of the measurement
+    for url in urls[:args.stations]:
+        plugin.onMessage(connection, {"Verb": "GET", "URL": url})
+    plugin.onHeartbeat()
+    env.updates = 0
+
+    latencies = []
+    heartbeat = 0.0
+    clock = time.perf_counter
+    count = len(urls)
+    started = clock()
+    for index in range(args.messages):
+        data = {"Verb": "GET", "URL": messages[index]}
+        begin = clock()
+        plugin.onMessage(connection, data)
+        latencies.append(clock() - begin)
+        if args.heartbeat and index % args.heartbeat == args.heartbeat - 1:
+            begin = clock()
+            plugin.onHeartbeat()
+            heartbeat += clock() - begin
+    elapsed = clock() - started
+    plugin.onStop()
+
+    latencies.sort()
+    print("corpus:        %i URLs, %i station(s)" % (count, args.stations))
+    print("onStart:       %.2f ms" % (startup * 1000.0))
+    print("messages:      %i in %.3f s, %.0f messages/s" % (args.messages, elapsed, args.messages / elapsed))
+    print("latency (us):  p50 %.1f  p90 %.1f  p99 %.1f  max %.1f" % (
+        percentile(latencies, 0.50) * 1e6, percentile(latencies, 0.90) * 1e6,
+        percentile(latencies, 0.99) * 1e6, latencies[-1] * 1e6))
+    print("heartbeats:    %.2f ms total" % (heartbeat * 1000.0))
+    print("Update calls:  %i (%.2f per message)" % (env.updates, float(env.updates) / args.messages))
+    print("dropped:       %i duplicate, %i stale" % (plugin._plugin.stats.duplicates, plugin._plugin.stats.stale))
+    if plugin._plugin.queue is not None:
+        queue = plugin._plugin.queue.snapshot()
+        print("ingest queue:  peak %i, %i dropped" % (queue["peak"], queue["dropped"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark BasePlugin.onMessage with a replayed URL corpus")
+    parser.add_argument("--corpus", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus.txt"), help="file with one upload URL per line")
+    parser.add_argument("--messages", type=int, default=20000, help="number of messages to replay")
+    parser.add_argument("--stations", type=int, default=1, help="number of stations to simulate")
+    parser.add_argument("--heartbeat", type=int, default=2, help="call onHeartbeat every N messages, 0 to disable (5 s uploads and 10 s heartbeats)")
+    parser.add_argument("--param", action="append", default=[], help="plugin parameter as Name=Value, e.g. Mode6=Debug")
+    args = parser.parse_args(argv)
+    args.parameters = dict(param.split("=", 1) for param in args.param)
+    bench(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+#
+# Equivalence check and micro-benchmark of the classifiers
+#
+# Compares getWindDirection, getPressureForecast, getBarometerForecast and
+# getHumidityStatus of plugin.py with the original if-ladders (kept below as
+# reference) over a dense grid of inputs, and times both versions.
+#
+# Usage:
+#   python3 tools/classifybench.py [--repeat 200000]
+#
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import domoticz_stub
+
+
+#
+# Reference implementations, the original comparisons
+#
+def referenceWindDirection(windBearing):
+    if windBearing == None:
+        return ""
+    if windBearing < 0 or windBearing > 360:
+        return ""
+    if windBearing > 348 or  windBearing <=  11:
+        return "N"
+    if windBearing >  11 and windBearing <=  33:
+        return "NNE"
+    if windBearing >  33 and windBearing <=  57:
+        return "NE"
+    if windBearing >  57 and windBearing <=  78:
+        return "ENE"
+    if windBearing >  78 and windBearing <= 102:
+        return "E"
+    if windBearing > 102 and windBearing <= 123:
+        return "ESE"
+    if windBearing > 123 and windBearing <= 157:
+        return "SE"
+    if windBearing > 157 and windBearing <= 168:
+        return "SSE"
+    if windBearing > 168 and windBearing <= 192:
+        return "S"
+    if windBearing > 192 and windBearing <= 213:
+        return "SSW"
+    if windBearing > 213 and windBearing <= 237:
+        return "SW"
+    if windBearing > 237 and windBearing <= 258:
+        return "WSW"
+    if windBearing > 258 and windBearing <= 282:
+        return "W"
+    if windBearing > 282 and windBearing <= 303:
+        return "WNW"
+    if windBearing > 303 and windBearing <= 327:
+        return "NW"
+    if windBearing > 327 and windBearing <= 348:
+        return "NNW"
+    return ""
+
+def referencePressureForecast(pressure):
+    if pressure < 966:
+        return 4
+    if pressure < 993:
+        return 6
+    if pressure < 1007:
+        return 2
+    if pressure < 1013:
+        return 3
+    if pressure < 1033:
+        return 0
+    return 1
+
+ReferenceOrder = (4, 6, 2, 3, 0, 1)
+
+def referenceBarometerForecast(pressure, tendency=None):
+    if pressure == None:
+        return 5
+    forecast = referencePressureForecast(pressure)
+    if tendency == None:
+        return forecast
+    if tendency <= -3.0:
+        return 4 if pressure < 1000 else 6
+    step = ReferenceOrder.index(forecast)
+    if tendency <= -1.0:
+        return ReferenceOrder[max(step - 1, 0)]
+    if tendency >= 1.0:
+        return ReferenceOrder[min(step + 1, len(ReferenceOrder) - 1)]
+    return forecast
+
+def referenceHumidityStatus(humidity, temperature):
+    if humidity == None:
+        return 0
+    if humidity <= 30:
+        return 2
+    if humidity >= 70:
+        return 3
+    if humidity >= 35 and humidity <= 65:
+        if temperature != None:
+            if temperature >= 22 and temperature <= 26:
+                return 1
+    return 0
+
+
+def frange(start, stop, step):
+    count = int(round((stop - start) / step))
+    return [round(start + index * step, 6) for index in range(count + 1)]
+
+
+def check(plugin):
+    bearings = [None] + frange(-5.0, 365.0, 0.1) + list(range(-5, 366))
+    pressures = frange(900.0, 1100.0, 0.05)
+    tendencies = [None] + frange(-5.0, 5.0, 0.25)
+    humidities = [None] + frange(0.0, 100.0, 0.5)
+    temperatures = [None] + frange(-10.0, 40.0, 0.25)
+    cases = [
+        ("getWindDirection", [(bearing,) for bearing in bearings], plugin.getWindDirection, referenceWindDirection),
+        ("getPressureForecast", [(pressure,) for pressure in pressures], plugin.getPressureForecast, referencePressureForecast),
+        ("getBarometerForecast", [(pressure, tendency) for pressure in [None] + pressures[::10] for tendency in tendencies],
+            plugin.getBarometerForecast, referenceBarometerForecast),
+        ("getHumidityStatus", [(humidity, temperature) for humidity in humidities for temperature in temperatures],
+            plugin.getHumidityStatus, referenceHumidityStatus)
+    ]
+    failed = 0
+    for name, inputs, function, reference in cases:
+        mismatches = [arguments for arguments in inputs if function(*arguments) != reference(*arguments)]
+        failed += len(mismatches)
+        print("%-21s %7i inputs, %i mismatch(es)%s" % (name + ":", len(inputs), len(mismatches),
+            (", e.g. %s" % (mismatches[0],)) if mismatches else ""))
+    return failed
+
+
+def bench(plugin, repeat):
+    bearings = [float(bearing % 360) + 0.5 for bearing in range(0, 3600, 7)]
+    pressures = [950.0 + index * 0.37 for index in range(250)]
+    climate = [(30.0 + index % 50, 15.0 + index % 15) for index in range(250)]
+    cases = [
+        ("getWindDirection", bearings, plugin.getWindDirection, referenceWindDirection),
+        ("getPressureForecast", pressures, plugin.getPressureForecast, referencePressureForecast),
+        ("getHumidityStatus", climate, lambda value: plugin.getHumidityStatus(*value), lambda value: referenceHumidityStatus(*value))
+    ]
+    for name, inputs, function, reference in cases:
+        count = len(inputs)
+        timings = []
+        for candidate in (reference, function):
+            def loop():
+                for index in range(repeat):
+                    candidate(inputs[index % count])
+            timings.append(min(timeit.repeat(loop, number=1, repeat=3)) / repeat * 1e9)
+        print("%-21s reference %6.0f ns, plugin %6.0f ns" % (name + ":", timings[0], timings[1]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check and benchmark the classifiers of plugin.py against the original if-ladders")
+    parser.add_argument("--repeat", type=int, default=200000, help="number of calls per timing")
+    args = parser.parse_args(argv)
+    plugin = domoticz_stub.load().plugin
+    failed = check(plugin)
+    bench(plugin, args.repeat)
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
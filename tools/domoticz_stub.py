@@ -0,0 +1,134 @@
+#
+# Stand-in for the Domoticz plugin environment
+#
+# Provides a fake Domoticz module, Devices and Parameters, so plugin.py can be
+# loaded and driven outside Domoticz by the benchmark and load tools.
+#
+# Usage:
+#   import domoticz_stub
+#   env = domoticz_stub.load(Parameters={"Port": "8008"})
+#   env.plugin.onStart()
+#   env.plugin.onMessage(domoticz_stub.Connection(), {"Verb": "GET", "URL": url})
+#   print(env.updates, env.Devices[7].sValue)
+#
+
+import importlib
+import os
+import sys
+import types
+
+RepoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DefaultParameters = {
+    "HomeFolder": RepoDir + os.sep,
+    "Port"      : "8008",
+    "Mode1"     : "",
+    "Mode2"     : "",
+    "Mode3"     : "",
+    "Mode4"     : "",
+    "Mode5"     : "",
+    "Mode6"     : "Normal"
+}
+
+
+class Device:
+    def __init__(self, env, Name, Unit, TypeName="", Used=0, Options=None, DeviceID=None, **kwargs):
+        self.env = env
+        self.Name = Name
+        self.Unit = Unit
+        self.TypeName = TypeName
+        self.Used = Used
+        self.Options = Options or {}
+        self.DeviceID = DeviceID if DeviceID is not None else "%08d" % Unit
+        self.ID = Unit
+        self.nValue = 0
+        self.sValue = ""
+        self.LastLevel = 0
+        self.TimedOut = 0
+
+    def Create(self):
+        self.env.Devices[self.Unit] = self
+
+    def Update(self, nValue, sValue, TimedOut=0, **kwargs):
+        self.nValue = nValue
+        self.sValue = sValue
+        self.TimedOut = TimedOut
+        self.env.updates += 1
+
+    def Delete(self):
+        del self.env.Devices[self.Unit]
+
+    def __str__(self):
+        return "Unit: %i, Name: '%s', sValue: '%s'" % (self.Unit, self.Name, self.sValue)
+
+
+class Connection:
+    def __init__(self, Name="Station", Transport="TCP/IP", Protocol="HTTP", Address="127.0.0.1", Port="50000", **kwargs):
+        self.Name = Name
+        self.Address = Address
+        self.Port = str(Port)
+        self.sent = 0
+        self.last = None
+
+    def Listen(self):
+        return
+
+    def Connect(self):
+        return
+
+    def Connected(self):
+        return True
+
+    def Send(self, Message, Delay=0):
+        self.sent += 1
+        self.last = Message
+
+    def Disconnect(self):
+        return
+
+
+class Environment:
+    def __init__(self, parameters, quiet):
+        self.Devices = {}
+        self.Parameters = dict(DefaultParameters)
+        self.Parameters.update(parameters or {})
+        self.updates = 0
+        self.log = []
+        self.quiet = quiet
+        self.plugin = None
+
+        module = types.ModuleType("Domoticz")
+        module.Log = self.record
+        module.Status = self.record
+        module.Debug = self.record
+        module.Error = self.record
+        module.Debugging = lambda level: None
+        module.Heartbeat = lambda seconds: None
+        module.Device = lambda *args, **kwargs: Device(self, *args, **kwargs)
+        module.Connection = Connection
+        self.module = module
+
+    def record(self, message):
+        if not self.quiet:
+            self.log.append(message)
+
+
+#
+# Load a fresh copy of plugin.py against a new stub environment
+#
+def load(Parameters=None, quiet=True):
+    env = Environment(Parameters, quiet)
+    sys.modules["Domoticz"] = env.module
+    if RepoDir not in sys.path:
+        sys.path.insert(0, RepoDir)
+    sys.modules.pop("plugin", None)
+    plugin = importlib.import_module("plugin")
+    plugin.Devices = env.Devices
+    plugin.Parameters = env.Parameters
+    env.plugin = plugin
+    return env
+
+
+def readCorpus(path):
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() != "" and not line.startswith("#")]
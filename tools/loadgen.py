@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+#
+# Station fleet load generator
+#
+# Simulates a fleet of stations uploading to plugin.py in the Domoticz
+# stand-in. Every station sends its own, slowly varying readings at its
+# realtime interval (rtfreq, with some jitter), a fraction of the uploads has
+# non-numeric, out of range or missing fields. The uploads and the 10 second
+# heartbeats run on a simulated clock, so ten minutes of a fleet take as long as
+# the plugin needs to process them.
+#
+# For every fleet size it reports the offered upload rate, the throughput and the
+# latency percentiles of onMessage, the share of one core the plugin needs to
+# keep up, the device writes per minute, rejected values and errors.
+#
+# Usage:
+#   python3 tools/loadgen.py [--fleet 1,5,10] [--duration 600] [--rtfreq 16] [--malformed 0.02]
+#
+
+import argparse
+import heapq
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import domoticz_stub
+
+HeartbeatInterval = 10.0
+StartTime = 1700000000.0
+
+
+#
+# Simulated clock for plugin.py, time() returns the simulated time and all
+# other functions are those of the time module
+#
+class Clock:
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+class SimulatedStation:
+    def __init__(self, stationID, rtfreq, rng):
+        self.id = stationID
+        self.rtfreq = rtfreq
+        self.rng = rng
+        self.tempf = rng.uniform(40.0, 80.0)
+        self.humidity = rng.uniform(40.0, 90.0)
+        self.baromin = rng.uniform(29.6, 30.2)
+        self.windspeed = rng.uniform(0.0, 10.0)
+        self.winddir = rng.uniform(0.0, 360.0)
+        self.solar = rng.uniform(0.0, 600.0)
+        self.dailyrain = 0.0
+
+    def interval(self):
+        return self.rtfreq * self.rng.uniform(0.9, 1.1)
+
+    def step(self):
+        rng = self.rng
+        self.tempf += rng.gauss(0.0, 0.05)
+        self.humidity = min(100.0, max(5.0, self.humidity + rng.gauss(0.0, 0.2)))
+        self.baromin += rng.gauss(0.0, 0.001)
+        self.windspeed = max(0.0, self.windspeed + rng.gauss(0.0, 0.8))
+        self.winddir = (self.winddir + rng.gauss(0.0, 10.0)) % 360.0
+        self.solar = max(0.0, self.solar + rng.gauss(0.0, 10.0))
+        if rng.random() < 0.02:
+            self.dailyrain += 0.01
+
+    def url(self, now, malformed):
+        self.step()
+        rng = self.rng
+        tempf = self.tempf
+        dewptf = tempf - (100.0 - self.humidity) * 9.0 / 25.0
+        fields = [
+            ("ID", self.id),
+            ("PASSWORD", "NoKeyNeeded"),
+            ("indoortempf", "%.1f" % (tempf + 10.0)),
+            ("tempf", "%.1f" % tempf),
+            ("dewptf", "%.1f" % dewptf),
+            ("windchillf", "%.1f" % tempf),
+            ("indoorhumidity", "%.0f" % max(5.0, self.humidity - 20.0)),
+            ("humidity", "%.0f" % self.humidity),
+            ("windspeedmph", "%.1f" % self.windspeed),
+            ("windgustmph", "%.1f" % (self.windspeed * rng.uniform(1.0, 1.6))),
+            ("winddir", "%.0f" % self.winddir),
+            ("absbaromin", "%.3f" % (self.baromin - 0.18)),
+            ("baromin", "%.3f" % self.baromin),
+            ("rainin", "%.3f" % (0.1 if rng.random() < 0.02 else 0.0)),
+            ("dailyrainin", "%.3f" % self.dailyrain),
+            ("solarradiation", "%.2f" % self.solar),
+            ("UV", "%.0f" % (self.solar / 100.0)),
+            ("dateutc", time.strftime("%Y-%m-%d%%20%H:%M:%S", time.gmtime(now))),
+            ("softwaretype", "EasyWeatherV1.4.1"),
+            ("action", "updateraw"),
+            ("realtime", "1"),
+            ("rtfreq", "%i" % self.rtfreq)
+        ]
+        if rng.random() < malformed:
+            index = rng.randrange(2, 17)
+            damage = rng.choice(("nonnumeric", "range", "missing"))
+            if damage == "nonnumeric":
+                fields[index] = (fields[index][0], "--")
+            elif damage == "range":
+                fields[index] = (fields[index][0], "-9999")
+            else:
+                del fields[index]
+        return "/weatherstation/updateweatherstation.php?" + "&".join("%s=%s" % field for field in fields)
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+# The plugin home folder (log file and snapshot) is a fresh temporary folder for every fleet size
+def simulate(args, size):
+    with tempfile.TemporaryDirectory() as folder:
+        parameters = dict(args.parameters)
+        parameters.setdefault("HomeFolder", os.path.join(folder, ""))
+        return run(args, parameters, size)
+
+
+def run(args, parameters, size):
+    env = domoticz_stub.load(Parameters=parameters)
+    plugin = env.plugin
+    clock = Clock(StartTime)
+    plugin.time = clock
+    errors = []
+    env.module.Error = errors.append
+
+    rng = random.Random(args.seed)
+    stations = [SimulatedStation("LG%04i" % index, args.rtfreq, rng) for index in range(size)]
+    plugin.onStart()
+    connections = [domoticz_stub.Connection(Name="LG%04i" % index, Port=50000 + index) for index in range(size)]
+    for connection in connections:
+        plugin.onConnect(connection, 0, "")
+
+    # Events are (simulated time, station index), index -1 is the heartbeat
+    events = [(StartTime + rng.uniform(0.0, station.rtfreq), index) for index, station in enumerate(stations)]
+    events.append((StartTime + HeartbeatInterval, -1))
+    heapq.heapify(events)
+
+    end = StartTime + args.duration
+    latencies = []
+    busy = 0.0
+    failures = 0
+    perf = time.perf_counter
+    while events and events[0][0] < end:
+        when, index = heapq.heappop(events)
+        clock.now = when
+        if index < 0:
+            started = perf()
+            plugin.onHeartbeat()
+            busy += perf() - started
+            heapq.heappush(events, (when + HeartbeatInterval, -1))
+            continue
+        station = stations[index]
+        data = {"Verb": "GET", "URL": station.url(when, args.malformed)}
+        started = perf()
+        try:
+            plugin.onMessage(connections[index], data)
+        except Exception:
+            failures += 1
+        elapsed = perf() - started
+        busy += elapsed
+        latencies.append(elapsed)
+        heapq.heappush(events, (when + station.interval(), index))
+    clock.now = end
+    plugin.onStop()
+
+    stats = plugin._plugin.stats
+    latencies.sort()
+    messages = len(latencies)
+    return {
+        "stations"  : size,
+        "offered"   : messages / args.duration,
+        "messages"  : messages,
+        "throughput": messages / sum(latencies) if latencies else 0.0,
+        "p50"       : percentile(latencies, 0.50) * 1e6,
+        "p99"       : percentile(latencies, 0.99) * 1e6,
+        "load"      : busy / args.duration * 100.0,
+        "writes"    : env.updates / (args.duration / 60.0),
+        "rejected"  : stats.outOfRange + stats.notNumeric + stats.spikes,
+        "errors"    : failures + len(errors),
+        "devices"   : len(env.Devices)
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate a fleet of stations uploading to the plugin")
+    parser.add_argument("--fleet", default="1,5,10", help="comma separated fleet sizes")
+    parser.add_argument("--duration", type=float, default=600.0, help="simulated seconds per fleet size")
+    parser.add_argument("--rtfreq", type=float, default=16.0, help="realtime upload interval of the stations in seconds")
+    parser.add_argument("--malformed", type=float, default=0.02, help="fraction of uploads with a bad or missing field")
+    parser.add_argument("--seed", type=int, default=1, help="random seed")
+    parser.add_argument("--param", action="append", default=[], help="plugin parameter as Name=Value, e.g. Mode3=ackfirst")
+    args = parser.parse_args(argv)
+    args.parameters = dict(param.split("=", 1) for param in args.param)
+
+    print("%8s %9s %8s %12s %8s %8s %7s %10s %9s %7s %8s" % ("stations", "offered/s", "messages", "throughput/s",
+        "p50 us", "p99 us", "load %", "writes/min", "rejected", "errors", "devices"))
+    for size in [int(size) for size in args.fleet.split(",")]:
+        result = simulate(args, size)
+        print("%8i %9.1f %8i %12.0f %8.1f %8.1f %7.2f %10.1f %9i %7i %8i" % (result["stations"], result["offered"],
+            result["messages"], result["throughput"], result["p50"], result["p99"], result["load"], result["writes"],
+            result["rejected"], result["errors"], result["devices"]))
+
+if __name__ == "__main__":
+    main()
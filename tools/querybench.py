@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+#
+# Micro-benchmark of the query string parser
+#
+# Compares parseQuery of plugin.py, with and without the key filter of the
+# compiled plan, against urllib.parse.parse_qs on the query strings of a corpus
+# of upload URLs. The results of both parsers are checked to agree on the keys
+# the plugin uses before timing.
+#
+# Usage:
+#   python3 tools/querybench.py [--corpus tools/corpus.txt] [--repeat 20000]
+#
+
+import argparse
+import os
+import sys
+import timeit
+import urllib.parse as urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import domoticz_stub
+
+
+def parseQs(query):
+    return dict((key, values[0]) for key, values in urlparse.parse_qs(query).items())
+
+
+def check(plugin, queries, keys):
+    mismatches = 0
+    for query in queries:
+        expected = parseQs(query)
+        if plugin.parseQuery(query) != expected:
+            mismatches += 1
+        elif plugin.parseQuery(query, keys) != dict((key, value) for key, value in expected.items() if key in keys):
+            mismatches += 1
+    return mismatches
+
+
+def run(args):
+    env = domoticz_stub.load()
+    plugin = env.plugin
+    keys = plugin.CompilePlan().keys
+    queries = [url.partition('?')[2] for url in domoticz_stub.readCorpus(args.corpus)]
+
+    mismatches = check(plugin, queries, keys)
+    print("queries:       %i, %i mismatch(es) with parse_qs" % (len(queries), mismatches))
+
+    candidates = [
+        ("parse_qs", lambda query: urlparse.parse_qs(query)),
+        ("parseQuery", lambda query: plugin.parseQuery(query)),
+        ("parseQuery keys", lambda query: plugin.parseQuery(query, keys))
+    ]
+    count = len(queries)
+    for name, function in candidates:
+        def loop():
+            for index in range(args.repeat):
+                function(queries[index % count])
+        elapsed = min(timeit.repeat(loop, number=1, repeat=3))
+        print("%-17s %.2f us per query" % (name + ":", elapsed / args.repeat * 1e6))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark parseQuery against urllib.parse.parse_qs")
+    parser.add_argument("--corpus", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus.txt"), help="file with one upload URL per line")
+    parser.add_argument("--repeat", type=int, default=20000, help="number of queries to parse per run")
+    args = parser.parse_args(argv)
+    run(args)
+
+if __name__ == "__main__":
+    main()
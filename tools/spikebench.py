@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+#
+# Equivalence check and micro-benchmark of the spike filter
+#
+# Feeds random series (smooth, noisy, with ties and with spikes) through
+# SpikeFilter of plugin.py and compares, for every value, the binary search MAD
+# of deviation() with the median of the sorted deviations, and the decision of
+# accept() with a brute force filter over a sorted copy of the window (kept
+# below as reference). Then times accept() of both, and estimates the overhead
+# per upload from the number of filtered parameters in the corpus.
+#
+# The overhead on the whole ingest path is measured by
+#   python3 tools/bench.py --param Mode3=spikefilter
+#
+# Usage:
+#   python3 tools/spikebench.py [--values 200000] [--check 5000] [--seed 1]
+#
+
+import argparse
+import collections
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import domoticz_stub
+
+
+#
+# Reference implementation, sorting the window and its deviations for every value
+#
+class ReferenceFilter:
+    def __init__(self, plugin, tolerance):
+        self.plugin = plugin
+        self.tolerance = tolerance
+        self.recent = collections.deque()
+
+    def accept(self, value):
+        plugin = self.plugin
+        ordered = sorted(self.recent)
+        count = len(ordered)
+        accepted = True
+        if count >= plugin.SpikeMinSamples:
+            middle = (count - 1) // 2
+            median = ordered[middle]
+            limit = plugin.SpikeThreshold * 1.4826 * referenceDeviation(ordered, middle, median)
+            accepted = abs(value - median) <= max(limit, self.tolerance)
+        if count >= plugin.SpikeWindow:
+            self.recent.popleft()
+        self.recent.append(value)
+        return accepted
+
+# The lower median of the absolute deviations, as SpikeFilter uses the lower median
+def referenceDeviation(ordered, middle, median):
+    return sorted(abs(value - median) for value in ordered)[middle]
+
+
+def series(rng, kind, count):
+    values = []
+    level = rng.uniform(-10.0, 30.0)
+    for index in range(count):
+        if kind == "smooth":
+            level += rng.gauss(0.0, 0.05)
+            values.append(round(level, 1))
+        elif kind == "noisy":
+            values.append(level + rng.gauss(0.0, 3.0))
+        elif kind == "ties":
+            values.append(float(rng.randint(18, 22)))
+        else:
+            level += rng.gauss(0.0, 0.1)
+            values.append(level + (rng.choice((-40.0, 40.0)) if rng.random() < 0.05 else 0.0))
+    return values
+
+
+def check(plugin, rng, count):
+    mismatches = 0
+    for kind in ("smooth", "noisy", "ties", "spikes"):
+        values = series(rng, kind, count)
+        spike = plugin.SpikeFilter(5.0)
+        reference = ReferenceFilter(plugin, 5.0)
+        deviations = 0
+        decisions = 0
+        for value in values:
+            ordered = spike.ordered
+            if len(ordered) >= 1:
+                middle = (len(ordered) - 1) // 2
+                median = ordered[middle]
+                if spike.deviation(middle, median) != referenceDeviation(ordered, middle, median):
+                    deviations += 1
+            if spike.accept(value) != reference.accept(value):
+                decisions += 1
+        print("%-7s %7i values, %i deviation and %i decision mismatch(es)" % (kind + ":", len(values), deviations, decisions))
+        mismatches += deviations + decisions
+    return mismatches
+
+
+def bench(plugin, rng, count):
+    values = series(rng, "spikes", count)
+    timings = []
+    for candidate in (ReferenceFilter(plugin, 5.0), plugin.SpikeFilter(5.0)):
+        accept = candidate.accept
+        def loop():
+            for value in values:
+                accept(value)
+        timings.append(min(timeit.repeat(loop, number=1, repeat=3)) / count * 1e9)
+    print("accept:  reference %6.0f ns, plugin %6.0f ns per value" % (timings[0], timings[1]))
+
+    # Filtered parameters per upload of the corpus
+    urls = domoticz_stub.readCorpus(os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus.txt"))
+    filtered = [sum(1 for key in plugin.parseQuery(url.partition('?')[2]) if key in plugin.SpikeFilters) for url in urls]
+    perUpload = float(sum(filtered)) / len(filtered)
+    print("upload:  %.1f filtered parameter(s), about %.1f us per upload" % (perUpload, perUpload * timings[1] / 1000.0))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check and benchmark the spike filter of plugin.py against a brute force reference")
+    parser.add_argument("--values", type=int, default=200000, help="number of values per timing")
+    parser.add_argument("--check", type=int, default=5000, help="number of values per checked series")
+    parser.add_argument("--seed", type=int, default=1, help="random seed")
+    args = parser.parse_args(argv)
+    plugin = domoticz_stub.load().plugin
+    rng = random.Random(args.seed)
+    failed = check(plugin, rng, args.check)
+    bench(plugin, rng, args.values)
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
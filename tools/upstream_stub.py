@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+#
+# Stand-in for a Wunderground compatible upload endpoint
+#
+# Accepts upload requests on any path, optionally slow or failing, and prints
+# the number of received uploads per station every few seconds. Use it as a
+# relay target of the plugin:
+#
+#   python3 tools/upstream_stub.py --port 8090 --delay 0.5 --fail 0.2
+#   python3 tools/bench.py --param Mode2=http://127.0.0.1:8090/weatherstation/updateweatherstation.php
+#
+
+import argparse
+import collections
+import http.server
+import random
+import threading
+import time
+import urllib.parse as urlparse
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        if server.delay:
+            time.sleep(server.delay)
+        query = urlparse.parse_qs(urlparse.urlsplit(self.path).query)
+        with server.lock:
+            server.received[query.get("ID", [""])[0]] += 1
+        status = 500 if random.random() < server.fail else 200
+        body = b"success\n" if status == 200 else b"error\n"
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        return
+
+
+def report(server, interval):
+    while True:
+        time.sleep(interval)
+        with server.lock:
+            counts = dict(server.received)
+        print("%s received: %i %s" % (time.strftime("%H:%M:%S"), sum(counts.values()), counts), flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stand-in for a Wunderground compatible upload endpoint")
+    parser.add_argument("--address", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8090, help="port to listen on")
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds to wait before every response")
+    parser.add_argument("--fail", type=float, default=0.0, help="fraction of the requests answered with 500")
+    parser.add_argument("--report", type=float, default=5.0, help="seconds between reports")
+    args = parser.parse_args(argv)
+
+    server = http.server.ThreadingHTTPServer((args.address, args.port), Handler)
+    server.delay = args.delay
+    server.fail = args.fail
+    server.lock = threading.Lock()
+    server.received = collections.Counter()
+    reporter = threading.Thread(target=report, args=(server, args.report))
+    reporter.daemon = True
+    reporter.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,442 @@
+#!/usr/bin/env python3
+#
+# Standalone ingest server for Wunderground formatted Weatherstation data
+#
+# Author: mveeten
+#
+# Runs the SensorTable conversion and the composite logic of plugin.py in an
+# asyncio HTTP server, outside Domoticz. Every accepted upload is written as a
+# reading to one or more sinks:
+#
+#   jsonl:<path>                 JSON lines appended to a file, "-" for stdout
+#   tcp:<host>:<port>            JSON lines sent over a TCP connection
+#   unix:<path>                  JSON lines sent over a Unix domain socket
+#   domoticz:<url>,<idxmap>      device updates through the Domoticz JSON API,
+#                                <idxmap> is a JSON file mapping "<station>:<key>"
+#                                or "<key>" to a Domoticz device idx
+#
+# Example:
+#   python3 wuserver.py --port 8008 --sink jsonl:readings.jsonl --workers 4
+#
+# With --workers the main process accepts the connections and parses the
+# requests, and routes every upload on its station ID to one of the worker
+# processes, which convert it and write the readings. A station always lands on
+# the same worker, so its duplicate detection, last known values and rolling
+# windows stay in one process.
+#
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import signal
+import sys
+import time
+import types
+import zlib
+import urllib.parse as urlparse
+
+log = logging.getLogger("wuserver")
+
+#
+# Stand-in for the Domoticz module, so plugin.py can be imported outside Domoticz.
+# Only the logging functions are provided, the pipeline does not use anything else.
+#
+def installDomoticzStandIn():
+    standin = types.ModuleType("Domoticz")
+    standin.Log = log.info
+    standin.Status = log.info
+    standin.Error = log.error
+    standin.Debug = log.debug
+    standin.Debugging = lambda level: log.setLevel(logging.DEBUG if level else logging.INFO)
+    sys.modules["Domoticz"] = standin
+
+try:
+    import Domoticz
+except ImportError:
+    installDomoticzStandIn()
+
+import plugin
+
+
+#
+# Sinks
+#
+class JsonLinesSink:
+    def __init__(self, path):
+        self.path = path
+        self.lines = []
+
+    async def write(self, reading):
+        self.lines.append(json.dumps(reading, separators=(',', ':')))
+
+    # Lines are written in one call per flush, so concurrent workers appending
+    # to the same file do not interleave within a line
+    async def flush(self):
+        if not self.lines:
+            return
+        data = "\n".join(self.lines) + "\n"
+        self.lines = []
+        if self.path == "-":
+            sys.stdout.write(data)
+            sys.stdout.flush()
+        else:
+            with open(self.path, "a") as f:
+                f.write(data)
+
+    async def close(self):
+        await self.flush()
+
+
+class SocketSink:
+    def __init__(self, address):
+        self.address = address
+        self.writer = None
+
+    async def connect(self):
+        if self.address[0] == "unix":
+            reader, self.writer = await asyncio.open_unix_connection(self.address[1])
+        else:
+            reader, self.writer = await asyncio.open_connection(self.address[1], self.address[2])
+
+    async def write(self, reading):
+        try:
+            if self.writer is None:
+                await self.connect()
+            self.writer.write((json.dumps(reading, separators=(',', ':')) + "\n").encode())
+        except OSError as e:
+            log.error("Socket sink %s unavailable, reading dropped: %s", ":".join(str(part) for part in self.address), e)
+            self.writer = None
+
+    async def flush(self):
+        if self.writer is not None:
+            try:
+                await self.writer.drain()
+            except OSError:
+                self.writer = None
+
+    async def close(self):
+        if self.writer is not None:
+            await self.flush()
+            self.writer.close()
+
+
+class DomoticzApiSink:
+    def __init__(self, url, idxmap):
+        parsed = urlparse.urlsplit(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.path = parsed.path.rstrip("/") + "/json.htm"
+        self.idxmap = idxmap
+        self.reader = None
+        self.writer = None
+
+    def lookup(self, station, key):
+        idx = self.idxmap.get("%s:%s" % (station, key))
+        if idx is None:
+            idx = self.idxmap.get(key)
+        return idx
+
+    async def update(self, idx, svalue):
+        query = urlparse.urlencode({"type": "command", "param": "udevice", "idx": idx, "nvalue": 0, "svalue": svalue})
+        request = "GET %s?%s HTTP/1.1\r\nHost: %s\r\nConnection: keep-alive\r\n\r\n" % (self.path, query, self.host)
+        for attempt in range(2):
+            try:
+                if self.writer is None:
+                    self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+                self.writer.write(request.encode())
+                await readResponse(self.reader)
+                return
+            except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+                self.writer = None
+                error = e
+        log.error("Domoticz update of idx %s failed: %s", idx, error)
+
+    async def write(self, reading):
+        station = reading["station"]
+        for key, value in reading["sensors"].items():
+            idx = self.lookup(station, key)
+            if idx is not None:
+                await self.update(idx, "%.1f" % value)
+        for name, svalue in reading["composites"].items():
+            idx = self.lookup(station, name)
+            if idx is not None:
+                await self.update(idx, svalue)
+
+    async def flush(self):
+        return
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def createSink(spec):
+    kind, _, target = spec.partition(":")
+    if kind == "jsonl":
+        return JsonLinesSink(target or "-")
+    if kind == "tcp":
+        host, _, port = target.rpartition(":")
+        return SocketSink(("tcp", host, int(port)))
+    if kind == "unix":
+        return SocketSink(("unix", target))
+    if kind == "domoticz":
+        url, _, mapfile = target.partition(",")
+        with open(mapfile) as f:
+            idxmap = json.load(f)
+        return DomoticzApiSink(url, idxmap)
+    raise ValueError("Unknown sink: %s" % spec)
+
+
+#
+# Ingest pipeline, the flow of the plugin (plugin.IngestRecords) without the devices
+#
+class Ingest:
+    def __init__(self, sinks):
+        self.plan = plugin.CompilePlan()
+        self.history = None
+        self.sinks = sinks
+        self.stations = {}      # station ID -> plugin.Station with the last known values and windows
+        self.pending = []      # readings of the request in process
+        self.messages = 0
+        self.rejected = 0
+        self.dropped = 0
+
+    def getStation(self, stationID):
+        station = self.stations.get(stationID)
+        if station is None:
+            plan = self.plan
+            station = self.stations[stationID] = plugin.Station(stationID, False,
+                [None] * plan.size, [None] * len(plan.composites), [window.createWindow() for window in plan.windows])
+        return station
+
+    def rejectSensor(self, key, value, reason):
+        self.rejected += 1
+        log.debug("Sensor value for %s %s: %s", key, reason, value)
+
+    def countOrder(self, station, order, dateutc):
+        self.dropped += 1
+
+    # Returns the readings for one request, raises ValueError for an unreadable batch
+    def readings(self, verb, url, body):
+        return self.process(*parseRequest(self.plan, verb, url, body))
+
+    # Returns the readings for the records of one request, a batch gives one reading per station
+    def process(self, records, batch):
+        self.pending = []
+        plugin.IngestRecords(self, records, batch)
+        return self.pending
+
+    # Called by plugin.IngestRecords for every fresh record. Composites are
+    # evaluated when one of their inputs changed, using the last known values of
+    # the station for the other inputs. No reading is written for an upload
+    # without a valid sensor value.
+    def ingest(self, record, sample, when):
+        plan = self.plan
+        station = self.getStation(str(record.get("ID", "")))
+        values = station.values
+        now = time.time()
+        station.lastSeen = now
+        converted = plugin.SampleRecord(self, station, record, sample, when, now)
+        if not converted:
+            return
+        composites = {}
+        for position in plan.affected(converted):
+            composite = plan.composites[position]
+            svalue = composite.evaluate(values)
+            if svalue is not None:
+                composites[composite.name] = svalue
+        self.messages += 1
+        self.pending.append({
+            "station"   : station.id,
+            "time"      : now,
+            "dateutc"   : record.get("dateutc"),
+            "sensors"   : dict((converter.key, values[converter.index]) for converter in converted),
+            "composites": composites
+        })
+
+    async def publish(self, readings):
+        for reading in readings:
+            for sink in self.sinks:
+                await sink.write(reading)
+
+
+# Returns the records of one request and whether it is a batch, raises ValueError for an unreadable batch.
+# A request that is not an upload, like /favicon.ico or /stats, has no records.
+def parseRequest(plan, verb, url, body):
+    record = plugin.parseQuery(urlparse.urlsplit(url).query)
+    if verb != "POST":
+        body = None
+    if not plugin.IsUpload(plan, record, body):
+        return [], False
+    if body:
+        records = plugin.parseBatch(body, record)
+        if records is None:
+            raise ValueError("Batch upload could not be parsed")
+        return records, True
+    return [record], False
+
+
+#
+# Station routing of --workers. The records of every station go to the worker
+# queue chosen by the CRC32 of its ID; the readings are published by the worker.
+#
+class Router:
+    def __init__(self, queues):
+        self.plan = plugin.CompilePlan()
+        self.queues = queues
+
+    def readings(self, verb, url, body):
+        records, batch = parseRequest(self.plan, verb, url, body)
+        if not records:
+            return []
+        groups = plugin.GroupRecords(records) if batch else [records]
+        for stationRecords in groups:
+            stationID = str(stationRecords[0].get("ID", ""))
+            self.queues[zlib.crc32(stationID.encode()) % len(self.queues)].put((stationRecords, batch))
+        return []
+
+    async def publish(self, readings):
+        return
+
+
+#
+# Minimal HTTP/1.1 server
+#
+async def readResponse(reader):
+    status = await reader.readline()
+    if not status:
+        raise asyncio.IncompleteReadError(b"", None)
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value)
+    if length:
+        await reader.readexactly(length)
+    return int(status.split()[1])
+
+ResponseOK  = b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\nConnection: keep-alive\r\n\r\n"
+ResponseBad = b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: keep-alive\r\n\r\n"
+
+async def serveClient(ingest, reader, writer):
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            verb, url, version = line.decode("latin-1").split()
+            length = 0
+            close = version == "HTTP/1.0"
+            while True:
+                header = await reader.readline()
+                if header in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = header.decode("latin-1").partition(":")
+                name = name.strip().lower()
+                if name == "content-length":
+                    length = int(value)
+                elif name == "connection":
+                    close = value.strip().lower() == "close"
+            body = await reader.readexactly(length) if length else b""
+            try:
+                readings = ingest.readings(verb, url, body)
+                writer.write(ResponseOK)
+            except ValueError as e:
+                log.error("%s", e)
+                readings = []
+                writer.write(ResponseBad)
+            await writer.drain()
+            await ingest.publish(readings)
+            if close:
+                break
+    except (OSError, ValueError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def flushSinks(sinks, interval):
+    while True:
+        await asyncio.sleep(interval)
+        for sink in sinks:
+            await sink.flush()
+
+# Serve the port with the ingest pipeline in this process, or with the Router of --workers
+async def serve(args, queues=None):
+    sinks = [] if queues else [createSink(spec) for spec in args.sink or ["jsonl:-"]]
+    ingest = Router(queues) if queues else Ingest(sinks)
+    server = await asyncio.start_server(lambda reader, writer: serveClient(ingest, reader, writer),
+        args.address, args.port)
+    log.info("Listening on %s:%i", args.address, args.port)
+    flusher = asyncio.ensure_future(flushSinks(sinks, args.flush))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        flusher.cancel()
+        for sink in sinks:
+            await sink.close()
+
+# Convert the records routed to this worker until None is received
+async def work(args, queue):
+    sinks = [createSink(spec) for spec in args.sink or ["jsonl:-"]]
+    ingest = Ingest(sinks)
+    flusher = asyncio.ensure_future(flushSinks(sinks, args.flush))
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            item = await loop.run_in_executor(None, queue.get)
+            if item is None:
+                break
+            await ingest.publish(ingest.process(*item))
+    finally:
+        flusher.cancel()
+        for sink in sinks:
+            await sink.close()
+
+def runServer(args, queues=None):
+    try:
+        asyncio.run(serve(args, queues))
+    except KeyboardInterrupt:
+        pass
+
+def runWorker(args, queue):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(work(args, queue))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Standalone ingest server for Wunderground formatted Weatherstation data")
+    parser.add_argument("--address", default="0.0.0.0", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8008, help="port to listen on")
+    parser.add_argument("--sink", action="append", help="output sink, can be given more than once (default jsonl:-)")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes converting the uploads, routed by station ID")
+    parser.add_argument("--flush", type=float, default=1.0, help="seconds between sink flushes")
+    parser.add_argument("--debug", action="store_true", help="log rejected values")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO, format="%(asctime)s %(processName)s %(message)s")
+    if args.workers > 1:
+        queues = [multiprocessing.Queue() for i in range(args.workers)]
+        workers = [multiprocessing.Process(target=runWorker, args=(args, queue), name="worker%i" % i) for i, queue in enumerate(queues)]
+        for worker in workers:
+            worker.start()
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            runServer(args, queues)
+        finally:
+            # Let the workers write what they received before stopping
+            for queue in queues:
+                queue.put(None)
+            for worker in workers:
+                worker.join(10)
+                if worker.is_alive():
+                    worker.terminate()
+    else:
+        runServer(args)
+
+if __name__ == "__main__":
+    main()